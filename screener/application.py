@@ -9,26 +9,83 @@
 from ConfigParser import SafeConfigParser
 from genshi.core import Stream
 from os import path, makedirs
-from screener.database import session
+from screener.database import (session, User, Image, image_cache,
+                               category_cache, category_versions)
 from screener.urls import url_map, handlers
 from screener.utils import (Request, Response, local, local_manager,
     generate_template, ImageAbuseReported, ImageAbuseConfirmed, url_for,
-    AdultContentException)
+    AdultContentException, page_cache, configure_templates)
 from screener.utils.crypto import gen_secret_key
 from screener.utils.notification import NotificationSystem
+from screener.utils.tasks import PeriodicTask
+from screener.utils.writebehind import WriteBehindBuffer, accumulate
+from screener.watermark import tiles
 from sqlalchemy import create_engine
 from sqlalchemy.exceptions import InvalidRequestError
 from time import time
 from types import ModuleType
+import logging
 from werkzeug.exceptions import HTTPException, NotFound, Unauthorized
 from werkzeug.utils import ClosingIterator, SharedDataMiddleware, redirect
+import atexit
 import sys
 
 
 #: path to shared data
 SHARED_DATA = path.join(path.dirname(__file__), 'shared')
 
-sys.modules['screener.config'] = config = ModuleType('config')
+#: options added after the first release, filled in when missing from an
+#: existing ``screener.ini``
+CONFIG_DEFAULTS = [
+    ('writebehind', 'last_visit', 'true'),
+    ('writebehind', 'interval', '30'),
+    ('writebehind', 'max_pending', '500'),
+    ('writebehind', 'views', 'true'),
+    ('writebehind', 'views_interval', '10'),
+    ('reaper', 'enabled', 'true'),
+    ('reaper', 'interval', '3600'),
+    ('reaper', 'max_age', '60'),
+    ('reaper', 'batch_size', '500'),
+    ('serving', 'block_size', '262144'),
+    ('serving', 'offload', 'none'),
+    ('serving', 'offload_prefix', '/_uploads'),
+    ('cache', 'images_size', '10000'),
+    ('cache', 'images_ttl', '300'),
+    ('cache', 'categories_size', '10000'),
+    ('cache', 'categories_ttl', '300'),
+    ('cache', 'pages_size', '1000'),
+    ('cache', 'pages_ttl', '60'),
+    ('cache', 'versions_ttl', '1'),
+    ('derivatives', 'deferred', 'false'),
+    ('derivatives', 'workers', '2'),
+    ('derivatives', 'poll_interval', '2'),
+    ('derivatives', 'max_attempts', '3'),
+    ('derivatives', 'job_timeout', '600'),
+    ('derivatives', 'retry_delay', '30'),
+    ('derivatives', 'reencode_originals', 'true'),
+    ('watermark', 'tile_cache_size', '100'),
+    ('storage', 'dedup', 'false'),
+    ('storage', 'shard_levels', '0'),
+    ('storage', 'shard_width', '2'),
+    ('storage', 'quota', '0'),
+    ('pagination', 'page_size', '60'),
+    ('notification', 'spool', 'true'),
+    ('notification', 'poll_interval', '30'),
+    ('notification', 'batch_size', '50'),
+    ('notification', 'max_attempts', '8'),
+    ('notification', 'retry_delay', '60'),
+    ('notification', 'idle_timeout', '60'),
+    ('notification', 'smtp_timeout', '30'),
+    ('server', 'workers', '0'),
+    ('server', 'threads', '8'),
+    ('server', 'max_requests', '1000'),
+    ('server', 'graceful_timeout', '30'),
+    ('templates', 'production', 'false'),
+    ('templates', 'streaming', 'true'),
+    ('templates', 'chunk_size', '8192'),
+]
+
+log = logging.getLogger(__name__)
 
 MESSAGE_404 = "The requested URL was not found on the server. If you entered" +\
               " the URL manually please check your spelling and try again."
@@ -40,6 +97,7 @@ class Screener(object):
         self.instance_folder = path.abspath(instance_folder)
         self.url_map = url_map
         self.init_screener()
+        config = self.config
         self.database_engine = create_engine(config.database_uri,
                                              echo=config.database_echo)
 
@@ -50,19 +108,124 @@ class Screener(object):
             '/shared':     SHARED_DATA
         })
 
-        # free the context locals at the end of the request
-        self._dispatch = local_manager.make_middleware(self._dispatch)
+        # Parse every template upfront when they're not expected to change
+        self.template_warmup = configure_templates(config.templates.production)
+        if config.templates.production:
+            log.info("Loaded %d templates in %.3f seconds" %
+                     self.template_warmup)
+
+        # Attach the notification system, queuing mail on the database
+        self.notification = NotificationSystem(config.notification,
+                                               self.database_engine)
+        self.mail_sender = self.notification.mail_sender
+
+        image_cache.configure(config.cache.images_size, config.cache.images_ttl)
+        category_cache.configure(config.cache.categories_size,
+                                 config.cache.categories_ttl)
+        page_cache.configure(config.cache.pages_size, config.cache.pages_ttl)
+        category_versions.configure(config.cache.categories_size,
+                                    config.cache.versions_ttl)
+        tiles.configure(config.watermark.tile_cache_size, tiles.ttl)
+
+        # Batched ``last_visit`` updates, see `Request.setup_cookie`
+        self.last_visits = None
+        if config.writebehind.last_visit:
+            self.last_visits = WriteBehindBuffer(
+                'last-visit-flusher',
+                lambda visits: User.update_last_visits(self.database_engine,
+                                                       visits),
+                interval=config.writebehind.interval,
+                max_pending=config.writebehind.max_pending
+            )
+
+        # Batched ``views`` increments, see `views.base.show_image`
+        self.view_counts = None
+        if config.writebehind.views:
+            self.view_counts = WriteBehindBuffer(
+                'view-counts-flusher',
+                lambda views: Image.add_views(self.database_engine, views),
+                interval=config.writebehind.views_interval,
+                max_pending=config.writebehind.max_pending,
+                merge=accumulate
+            )
+
+        # Periodic removal of stale anonymous users, see `reap_stale_users`
+        self.reaper = None
+        if config.reaper.enabled:
+            self.reaper = PeriodicTask('stale-users-reaper',
+                                       self.reap_stale_users,
+                                       config.reaper.interval)
+
+        self.start_background_tasks()
+        atexit.register(self.shutdown)
+
+    @property
+    def background_tasks(self):
+        tasks = [task for task in (self.last_visits, self.view_counts,
+                                   self.reaper) if task is not None]
+        if self.mail_sender is not None:
+            tasks.append(self.mail_sender.task)
+        return tasks
+
+    def start_background_tasks(self, maintenance=True):
+        """Start the background tasks, without the stale users reaper when
+        ``maintenance`` is false, so there's only one of it running across
+        processes."""
+        for task in self.background_tasks:
+            if maintenance or task is not self.reaper:
+                task.start()
 
-        # Attach the notification system
-        self.notification = NotificationSystem(config.notification)
+    def stop_background_tasks(self):
+        for task in self.background_tasks:
+            task.stop()
+
+    def shutdown(self):
+        """Flush anything still held in memory.  Registered with `atexit`,
+        call it explicitly when the server exits some other way."""
+        self.stop_background_tasks()
+        if self.mail_sender is not None:
+            self.mail_sender.close()
+
+    def before_fork(self):
+        """Get ready for the process to be forked: threads aren't copied to
+        the child processes, nor should database or SMTP connections be
+        shared with them."""
+        self.stop_background_tasks()
+        if self.mail_sender is not None:
+            self.mail_sender.close()
+        session.remove()
+        self.database_engine.dispose()
+
+    def after_fork(self, maintenance=True):
+        """Called on each forked process, see `before_fork`."""
+        self.start_background_tasks(maintenance)
+
+    def reap_stale_users(self):
+        """Delete the anonymous users which haven't been around for
+        ``[reaper] max_age`` days and everything they own."""
+        from screener.maintenance import reap_stale_users
+        if self.last_visits is not None:
+            # Don't reap someone whose visit is still waiting in the buffer
+            self.last_visits.flush()
+        reclaimed = reap_stale_users(self.database_engine,
+                                     self.config.reaper.max_age,
+                                     self.config.reaper.batch_size)
+        if reclaimed['users']:
+            log.info("Reaped %d stale users: %s", reclaimed['users'],
+                     ', '.join('%s=%d' % item for item in
+                               sorted(reclaimed.items())))
+        return reclaimed
 
     def init_screener(self):
         if not path.exists(self.instance_folder):
             makedirs(path.join(self.instance_folder))
         parser = SafeConfigParser()
+        # Every application has its own, never shared with another one
+        config = ModuleType('config')
 
         config_file = path.join(self.instance_folder, 'screener.ini')
-        if not path.isfile(config_file):
+        new_config_file = not path.isfile(config_file)
+        if new_config_file:
             parser.add_section('main')
             parser.set('main', 'database_uri', 'sqlite:///%(here)s/database.db')
             parser.set('main', 'database_echo', 'false')
@@ -86,10 +249,18 @@ class Screener(object):
             parser.set('notification', 'from_name', 'Screener')
             parser.set('notification', 'reply_to', '')
             parser.set('notification', 'use_tls', 'false')
-            parser.write(open(config_file, 'w'))
         else:
             parser.readfp(open(config_file))
 
+        for section, option, value in CONFIG_DEFAULTS:
+            if not parser.has_section(section):
+                parser.add_section(section)
+            if not parser.has_option(section, option):
+                parser.set(section, option, value)
+
+        if new_config_file:
+            parser.write(open(config_file, 'w'))
+
         parser.set('DEFAULT', 'here', self.instance_folder)
 
         config.database_uri = parser.get('main', 'database_uri')
@@ -110,6 +281,8 @@ class Screener(object):
         watermark.optional = parser.getboolean('watermark', 'optional')
         watermark.font = parser.get('watermark', 'font')
         watermark.text = parser.get('watermark', 'text')
+        watermark.tile_cache_size = parser.getint('watermark',
+                                                  'tile_cache_size')
 
         config.notification = notification = ModuleType('config.notification')
         notification.enabled = parser.getboolean('notification', 'enabled')
@@ -121,6 +294,88 @@ class Screener(object):
         notification.from_name = parser.get('notification', 'from_name')
         notification.reply_to =  parser.get('notification', 'reply_to')
         notification.use_tls = parser.getboolean('notification', 'use_tls')
+        notification.spool = parser.getboolean('notification', 'spool')
+        notification.poll_interval = parser.getint('notification',
+                                                   'poll_interval')
+        notification.batch_size = parser.getint('notification', 'batch_size')
+        notification.max_attempts = parser.getint('notification',
+                                                  'max_attempts')
+        notification.retry_delay = parser.getint('notification', 'retry_delay')
+        notification.idle_timeout = parser.getint('notification',
+                                                  'idle_timeout')
+        notification.smtp_timeout = parser.getint('notification',
+                                                  'smtp_timeout')
+
+        config.writebehind = writebehind = ModuleType('config.writebehind')
+        writebehind.last_visit = parser.getboolean('writebehind', 'last_visit')
+        writebehind.interval = parser.getint('writebehind', 'interval')
+        writebehind.max_pending = parser.getint('writebehind', 'max_pending')
+        writebehind.views = parser.getboolean('writebehind', 'views')
+        writebehind.views_interval = parser.getint('writebehind',
+                                                   'views_interval')
+
+        config.reaper = reaper = ModuleType('config.reaper')
+        reaper.enabled = parser.getboolean('reaper', 'enabled')
+        reaper.interval = parser.getint('reaper', 'interval')
+        reaper.max_age = parser.getint('reaper', 'max_age')
+        reaper.batch_size = parser.getint('reaper', 'batch_size')
+
+        config.serving = serving = ModuleType('config.serving')
+        serving.block_size = parser.getint('serving', 'block_size')
+        serving.offload = parser.get('serving', 'offload').lower()
+        if serving.offload in ('', 'none', 'false'):
+            serving.offload = None
+        elif serving.offload not in ('x-accel-redirect', 'x-sendfile'):
+            print "[serving] offload must be one of 'none', " \
+                  "'x-accel-redirect' or 'x-sendfile'"
+            sys.exit()
+        serving.offload_prefix = parser.get('serving', 'offload_prefix')
+
+        config.cache = cache = ModuleType('config.cache')
+        cache.images_size = parser.getint('cache', 'images_size')
+        cache.images_ttl = parser.getint('cache', 'images_ttl')
+        cache.categories_size = parser.getint('cache', 'categories_size')
+        cache.categories_ttl = parser.getint('cache', 'categories_ttl')
+        cache.pages_size = parser.getint('cache', 'pages_size')
+        cache.pages_ttl = parser.getint('cache', 'pages_ttl')
+        cache.versions_ttl = parser.getint('cache', 'versions_ttl')
+
+        config.derivatives = derivatives = ModuleType('config.derivatives')
+        derivatives.deferred = parser.getboolean('derivatives', 'deferred')
+        derivatives.workers = parser.getint('derivatives', 'workers')
+        derivatives.poll_interval = parser.getint('derivatives',
+                                                  'poll_interval')
+        derivatives.max_attempts = parser.getint('derivatives', 'max_attempts')
+        derivatives.job_timeout = parser.getint('derivatives', 'job_timeout')
+        derivatives.retry_delay = parser.getint('derivatives', 'retry_delay')
+        derivatives.reencode_originals = parser.getboolean(
+            'derivatives', 'reencode_originals')
+
+        config.storage = storage = ModuleType('config.storage')
+        storage.dedup = parser.getboolean('storage', 'dedup')
+        storage.shard_levels = parser.getint('storage', 'shard_levels')
+        storage.shard_width = parser.getint('storage', 'shard_width')
+        storage.quota = parser.getint('storage', 'quota')
+
+        config.server = server = ModuleType('config.server')
+        server.workers = parser.getint('server', 'workers')
+        if not server.workers:
+            from multiprocessing import cpu_count
+            server.workers = cpu_count()
+        server.threads = max(parser.getint('server', 'threads'), 1)
+        server.max_requests = parser.getint('server', 'max_requests')
+        server.graceful_timeout = parser.getint('server', 'graceful_timeout')
+
+        config.templates = templates = ModuleType('config.templates')
+        templates.production = parser.getboolean('templates', 'production')
+        templates.streaming = parser.getboolean('templates', 'streaming')
+        templates.chunk_size = parser.getint('templates', 'chunk_size')
+
+        config.pagination = pagination = ModuleType('config.pagination')
+        pagination.page_size = max(parser.getint('pagination', 'page_size'), 1)
+        if storage.shard_levels * storage.shard_width > 40:
+            raise ValueError("[storage] shard_levels * shard_width can't "
+                             "exceed the 40 hexadecimal digits of a sha1")
         if not path.isdir(config.uploads_path):
             makedirs(config.uploads_path)
         self.config = config
@@ -178,18 +433,19 @@ class Screener(object):
         # current context and instanciating the database session.
         self.bind_to_context()
         request = Request(environ)
-        request.config = config
+        request.config = config = self.config
         request.notification = self.notification
-        request.bind_to_context()
-        request.setup_cookie()
-
-#        self.url_adapter = url_map.bind_to_environ(
+#        request.url_adapter = url_map.bind_to_environ(
 #            environ, server_name=config.domain
 #        )
-        self.url_adapter = url_map.bind_to_environ(environ)
+        # Bound to this request's environment, kept on the request as the
+        # application is shared by the threads serving requests
+        request.url_adapter = url_map.bind_to_environ(environ)
+        request.bind_to_context()
+        request.setup_cookie()
 
         try:
-            endpoint, params = self.url_adapter.match()
+            endpoint, params = request.url_adapter.match()
             request.endpoint = endpoint
             action = handlers[endpoint]
             response = action(request, **params)
@@ -222,6 +478,11 @@ class Screener(object):
         except HTTPException, e:
             response = e.get_response(environ)
 
+        if getattr(response, 'from_template', False):
+            # A streamed page renders after the cookie is sent, take the
+            # messages it shows off the session before that
+            request.pop_flashes('errors')
+            request.pop_flashes()
         if request.session.should_save:
             if request.session.get('pmt'):
                 max_age = 60 * 60 * 24 * 31
@@ -231,13 +492,28 @@ class Screener(object):
             request.session.save_cookie(response, config.cookie_name,
                                         max_age=max_age, expires=expires,
                                         session_expires=expires)
+        if getattr(response, 'direct_passthrough', False):
+            # Most likely a `wsgi.file_wrapper`, which the server only
+            # recognizes if we don't wrap it.  Nothing left needs the
+            # database session nor the context locals, free them now.
+            request.discard_uploads()
+            local_manager.cleanup()
+            session.remove()
+            return response(environ, start_response)
         try:
             return ClosingIterator(response(environ, start_response),
-                                   [local_manager.cleanup, session.remove])
+                                   [request.discard_uploads,
+                                    local_manager.cleanup, session.remove])
         except InvalidRequestError:
             session.rollback()
 
 
     def __call__(self, environ, start_response):
         """Just forward a WSGI call to the first internal middleware."""
-        return self._dispatch(environ, start_response)
+        try:
+            return self._dispatch(environ, start_response)
+        except:
+            # free the context locals if the request didn't make it to the
+            # point where `dispatch_request` takes care of that
+            local_manager.cleanup()
+            raise
@@ -8,22 +8,32 @@
 from datetime import datetime
 from hashlib import sha1, md5
 from os import remove, removedirs
-from os.path import basename, splitext, dirname, join, islink, getsize
-from random import choice
+from os.path import (basename, splitext, dirname, join, islink, isfile,
+                     getsize)
+from random import getrandbits
 from screener.utils import application, local, local_manager, url_for
+from screener.utils.cache import LRUCache
 from screener.utils.crypto import gen_pwhash, check_pwhash
 from sqlalchemy import (Column, Integer, String, DateTime, ForeignKey, Boolean,
-                        PickleType, and_, or_)
+                        Index, and_, or_, bindparam, func, select)
+from sqlalchemy.exceptions import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (create_session, scoped_session, relation, Query,
                             deferred, dynamic_loader, backref, MapperExtension,
                             EXT_CONTINUE)
+from sqlalchemy.orm.attributes import get_history, instance_state
 from uuid import uuid4
 
 
 DeclarativeBase = declarative_base()
 metadata = DeclarativeBase.metadata
 
+#: keep ``IN (...)`` lists below SQLite's limit of bound parameters
+IN_CLAUSE_SIZE = 400
+
+#: how an image's stamp is written in page cursors, see `Image.cursor`
+CURSOR_STAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
 def new_db_session():
     """
     This function creates a new session if there is no session yet for
@@ -35,12 +45,266 @@ def new_db_session():
     return create_session(application.database_engine, autoflush=True,
                           autocommit=False)
 
+def version_paths(path, filename):
+    """Return the paths of an image stored as ``filename`` on ``path``, and
+    of its resized and thumbnail versions."""
+    name, extension = splitext(filename)
+    return (join(path, filename),
+            join(path, "%s.resized%s" % (name, extension)),
+            join(path, "%s.thumbnail%s" % (name, extension)))
+
+def shard_directory(directory, name, levels, width=2):
+    """Return the directory below ``directory`` where ``name`` is stored,
+    spread over ``levels`` levels of subdirectories named after ``width``
+    characters long prefixes of its sha1, ``directory`` itself when
+    ``levels`` is 0."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    digest = sha1(name).hexdigest()
+    return join(directory, *[digest[level*width:(level+1)*width]
+                             for level in range(levels)])
+
+def remove_image_files(path, filename):
+    """Remove an image, its resized and thumbnail versions and, if it ends
+    up empty, the directory holding them."""
+    for filepath in version_paths(path, filename):
+        try:
+            remove(filepath)
+        except OSError:
+            # File does not exist!?
+            pass
+    try:
+        removedirs(path)
+    except OSError:
+        # Directory not empty
+        pass
+
+def file_size(path):
+    """Size of the file at ``path``, 0 for symlinks to the original and
+    versions still waiting on the derivative workers."""
+    if islink(path) or not isfile(path):
+        return 0
+    return getsize(path)
+
+def disk_usage(image_size, resized_size, thumb_size, reported=False):
+    """What an image with those sizes adds to its owner's disk usage,
+    everything counts as abuse once it's ``reported``."""
+    image_size, resized_size, thumb_size = \
+                        image_size or 0, resized_size or 0, thumb_size or 0
+    if reported:
+        return dict(abuse=image_size + resized_size + thumb_size)
+    return dict(images=image_size, resized=resized_size, thumbs=thumb_size)
+
+def usage_difference(new, old):
+    difference = dict(new)
+    for counter, amount in old.iteritems():
+        difference[counter] = difference.get(counter, 0) - amount
+    return difference
+
+def image_counts(private, adult_content, reported=False):
+    """What an image adds to its category's image counters: every image
+    counts among ``all``, the public ones nobody reported among ``public``
+    or, for adult content, ``adult``."""
+    counts = dict(all=1)
+    if not (private or reported):
+        counts[adult_content and 'adult' or 'public'] = 1
+    return counts
+
+def image_sizes(connection, image_id):
+    """``(owner_uid, image_size, resized_size, thumb_size)`` of an image,
+    `None` if it doesn't exist (anymore)."""
+    images = Image.__table__
+    return connection.execute(select(
+        [images.c.owner_uid, images.c.image_size, images.c.resized_size,
+         images.c.thumb_size], images.c.id==image_id)).fetchone()
+
+def is_reported(connection, image_id):
+    reports = Abuse.__table__
+    return connection.execute(select([reports.c.hash],
+                                     reports.c.image_id==image_id,
+                                     limit=1)).fetchone() is not None
+
+
 class DeleteMapperExtension(MapperExtension):
     def after_delete(self, mapper, connection, instance):
         if hasattr(instance, '__delete__'):
-            instance.__delete__()
+            instance.__delete__(connection)
         return EXT_CONTINUE
 
+
+class DiskUsageMapperExtension(MapperExtension):
+    """Keep the owner's disk usage counters in step with the sizes recorded
+    on each `Image`, on the transaction flushing it."""
+
+    def sizes(self, instance, side):
+        state = instance_state(instance)
+        sizes = []
+        for attribute in ('image_size', 'resized_size', 'thumb_size'):
+            added, unchanged, deleted = get_history(state, attribute)
+            values = {'new': added or unchanged,
+                      'old': deleted or unchanged}[side]
+            sizes.append(values and values[0] or 0)
+        return sizes
+
+    def after_insert(self, mapper, connection, instance):
+        User.charge(connection, instance.owner_uid,
+                    disk_usage(*self.sizes(instance, 'new')))
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        old, new = self.sizes(instance, 'old'), self.sizes(instance, 'new')
+        if old != new:
+            reported = is_reported(connection, instance.id)
+            User.charge(connection, instance.owner_uid, usage_difference(
+                disk_usage(*new, reported=reported),
+                disk_usage(*old, reported=reported)))
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        # Reports are deleted before their image, which by now counts as
+        # one that's not reported
+        reported = is_reported(connection, instance.id)
+        User.charge(connection, instance.owner_uid, usage_difference(
+            {}, disk_usage(*self.sizes(instance, 'old'), reported=reported)))
+        return EXT_CONTINUE
+
+
+class ImageCountMapperExtension(MapperExtension):
+    """Keep the image counters of each `Image`'s category in step, on the
+    transaction flushing it, see `Category.count`."""
+
+    def counted(self, connection, instance, side):
+        """The category ``instance`` is counted on, and how."""
+        state = instance_state(instance)
+        values = []
+        for attribute in ('category_name', 'private', 'adult_content'):
+            added, unchanged, deleted = get_history(state, attribute)
+            values.append((added or unchanged, deleted or unchanged)[
+                side == 'old'])
+        category_name, private, adult_content = \
+                                [value and value[0] or None for value in values]
+        # Reports are deleted before their image, which by now counts as
+        # one that's not reported
+        return category_name, image_counts(private, adult_content,
+                                           is_reported(connection, instance.id))
+
+    def after_insert(self, mapper, connection, instance):
+        Category.count(connection, *self.counted(connection, instance, 'new'))
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        old = self.counted(connection, instance, 'old')
+        new = self.counted(connection, instance, 'new')
+        if old != new:
+            Category.count(connection, old[0], usage_difference({}, old[1]))
+            Category.count(connection, *new)
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        category_name, counts = self.counted(connection, instance, 'old')
+        Category.count(connection, category_name,
+                       usage_difference({}, counts))
+        return EXT_CONTINUE
+
+
+def charge_report(connection, image_id, reported):
+    """Move an image's disk usage to its owner's abuse counter, or back
+    from it, as it gets ``reported`` or not anymore, and count it among
+    its category's visible images or not."""
+    row = image_sizes(connection, image_id)
+    if row is not None:
+        owner_uid, sizes = row[0], tuple(row[1:])
+        User.charge(connection, owner_uid, usage_difference(
+            disk_usage(*sizes, reported=reported),
+            disk_usage(*sizes, reported=not reported)))
+    images = Image.__table__
+    row = connection.execute(select(
+        [images.c.category_name, images.c.private, images.c.adult_content],
+        images.c.id==image_id)).fetchone()
+    if row is not None:
+        Category.count(connection, row[0], usage_difference(
+            image_counts(row[1], row[2], reported),
+            image_counts(row[1], row[2], not reported)))
+
+
+def bump_category_version(connection, category_name=None, image_id=None,
+                          blob_key=None):
+    """Note that what's shown of a category, named, the one holding an
+    image or those holding the images stored on a blob, has changed, so
+    that pages rendered and records cached before, by any process, aren't
+    reused.  So has the categories list, see `Counter.CATEGORIES`."""
+    categories = Category.__table__
+    images = Image.__table__
+    if blob_key is not None:
+        criterion = categories.c.name.in_(select(
+            [images.c.category_name], images.c.blob_key==blob_key))
+    elif category_name is None:
+        criterion = categories.c.name==select(
+            [images.c.category_name], images.c.id==image_id).as_scalar()
+    else:
+        criterion = categories.c.name==category_name
+    connection.execute(categories.update(criterion, values={
+        categories.c.version: func.coalesce(categories.c.version, 0) + 1}))
+    Counter.bump(connection, Counter.CATEGORIES)
+    # Which categories changed isn't known by name here
+    category_versions.clear()
+
+
+class CategoryVersionMapperExtension(MapperExtension):
+    """Bump the version of the category shown changing, see
+    `bump_category_version`."""
+
+    def bump(self, connection, instance):
+        if isinstance(instance, Category):
+            bump_category_version(connection, instance.name)
+        elif isinstance(instance, Image):
+            bump_category_version(connection, instance.category_name)
+        else:
+            bump_category_version(connection, image_id=instance.image_id)
+
+    def after_insert(self, mapper, connection, instance):
+        self.bump(connection, instance)
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        if isinstance(instance, Image):
+            # Counting views, the most common update, changes no listing
+            state = instance_state(instance)
+            changed = [column.key for column in Image.__table__.columns
+                       if column.key != 'views' and
+                       get_history(state, column.key)[0]]
+            if not changed:
+                return EXT_CONTINUE
+        self.bump(connection, instance)
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        if isinstance(instance, Category):
+            # Gone with its version, only the categories list is left
+            Counter.bump(connection, Counter.CATEGORIES)
+        else:
+            self.bump(connection, instance)
+        return EXT_CONTINUE
+
+
+class AbuseMapperExtension(MapperExtension):
+    def after_insert(self, mapper, connection, instance):
+        charge_report(connection, instance.image_id, True)
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        charge_report(connection, instance.image_id, False)
+        return EXT_CONTINUE
+
+#: ``(category, image)`` as found on the URL -> `ImageRecord`, sized by the
+#: application from the ``[cache]`` configuration section
+image_cache = LRUCache('images')
+#: category name or secret -> `CategoryRecord`, see `Category.resolve`
+category_cache = LRUCache('categories')
+#: category name -> its version, as last looked up, trusted for the
+#: ``[cache] versions_ttl`` seconds, see `Category.current_version`
+category_versions = LRUCache('category versions', ttl=1)
+
 # and create a new global session factory.  Calling this object gives
 # you the current active session
 session = scoped_session(lambda: new_db_session(), local_manager.get_ident)
@@ -51,14 +315,16 @@ class User(DeclarativeBase):
 
     uuid                = Column(String(32), primary_key=True)
     username            = Column(String, index=True)
-    email               = Column(String)
+    email               = Column(String, index=True)
     confirmed           = Column(Boolean, default=False)
     passwd_hash         = Column(String)
     last_visit          = Column(DateTime, default=datetime.utcnow())
     last_login          = Column(DateTime, default=datetime.utcnow())
-    disk_usage          = deferred(Column(PickleType,
-                                         default=dict(images=0, resized=0,
-                                                      thumbs=0, abuse=0)))
+    usage_images        = Column(Integer, default=0)
+    usage_resized       = Column(Integer, default=0)
+    usage_thumbs        = Column(Integer, default=0)
+    usage_abuse         = Column(Integer, default=0)
+    disk_quota          = Column(Integer)
     show_adult_content  = Column(Boolean, default=False)
     agreed_to_tos       = Column(Boolean, default=False)
     is_admin            = Column(Boolean, default=False)
@@ -114,26 +380,66 @@ class User(DeclarativeBase):
     def update_last_visit(self):
         self.last_visit = datetime.utcnow()
 
-    def update_disk_usage(self):
-        images = resized = thumbs = abuse = 0
-        for image in self.images:
-            if image.abuse:
-                abuse += getsize(image.image_path) + getsize(image.thumb_path)
-                if not islink(image.resized_path):
-                    abuse += getsize(image.resized_path)
-            else:
-                images += getsize(image.image_path)
-                thumbs += getsize(image.thumb_path)
-                if not islink(image.resized_path):
-                    resized += getsize(image.resized_path)
-
-        self.disk_usage = dict(
-            images=images,
-            resized=resized,
-            thumbs=thumbs,
-            abuse=abuse
+    @classmethod
+    def update_last_visits(cls, engine, visits):
+        """Bulk write a ``{uuid: last_visit}`` mapping in one statement."""
+        users = cls.__table__
+        engine.execute(
+            users.update(users.c.uuid==bindparam('_uuid'),
+                         values={users.c.last_visit: bindparam('_last_visit')}),
+            [{'_uuid': uuid, '_last_visit': last_visit}
+             for uuid, last_visit in visits.iteritems()]
         )
 
+    @property
+    def disk_usage(self):
+        """Bytes used by the images, resized and thumbnail versions, and by
+        the reported images of this user."""
+        return dict(images=self.usage_images or 0,
+                    resized=self.usage_resized or 0,
+                    thumbs=self.usage_thumbs or 0,
+                    abuse=self.usage_abuse or 0)
+
+    @property
+    def quota(self):
+        """Bytes this user may use, ``[storage] quota`` unless set for the
+        user, 0 meaning there's no limit."""
+        if self.disk_quota is not None:
+            return self.disk_quota
+        return application.config.storage.quota
+
+    def owns_private(self):
+        """Whether this user has private images or categories, which only
+        they, and admins, get to see listed."""
+        for model in (Image, Category):
+            if session.query(model.owner_uid).filter(and_(
+                    model.owner_uid==self.uuid, model.private==True)).first():
+                return True
+        return False
+
+    def exceeds_quota(self, size):
+        """Whether ``size`` more bytes would take the user over quota."""
+        return self.quota and \
+                    sum(self.disk_usage.values()) + size > self.quota or False
+
+    @classmethod
+    def charge(cls, connection, uuid, usage):
+        """Add ``usage``, a dictionary as returned by `disk_usage` whose
+        amounts might be negative, to the user's disk usage counters."""
+        users = cls.__table__
+        values = {}
+        for counter, amount in usage.iteritems():
+            if amount:
+                column = users.c['usage_%s' % counter]
+                values[column] = func.coalesce(column, 0) + amount
+        if values and uuid is not None:
+            connection.execute(users.update(users.c.uuid==uuid, values=values))
+
+
+# Stale users, see `screener.maintenance.reap_stale_users`
+Index('ix_users_confirmed_last_visit', User.__table__.c.confirmed,
+      User.__table__.c.last_visit)
+
 
 class Change(DeclarativeBase):
     __tablename__ = 'persistent'
@@ -141,7 +447,7 @@ class Change(DeclarativeBase):
     hash = Column('id', String(32), primary_key=True)
     name = Column(String)
     value = Column(String)
-    owner_uid = Column(None, ForeignKey('users.uuid'))
+    owner_uid = Column(None, ForeignKey('users.uuid'), index=True)
 
     # ForeignKey Association
     owner     = None   # Defined on User.changes
@@ -164,7 +470,7 @@ class Leecher(DeclarativeBase):
     __tablename__ = 'leechers'
 
     key       = Column(String(32), primary_key=True)
-    owner_uid = Column(None, ForeignKey('users.uuid'))
+    owner_uid = Column(None, ForeignKey('users.uuid'), index=True)
 
     # ForeignKey Association
     owner     = None   # Defined on User.categories
@@ -194,6 +500,8 @@ class LeechDomain(DeclarativeBase):
 
 class Abuse(DeclarativeBase):
     __tablename__ = 'reports'
+    __mapper_args__ = {'extension': [AbuseMapperExtension(),
+                                     CategoryVersionMapperExtension()]}
 
     # Table Columns
     hash           = Column(String(40), primary_key=True)
@@ -202,8 +510,8 @@ class Abuse(DeclarativeBase):
     reason         = deferred(Column(String))
     reporter_ip    = deferred(Column(String(15)))
     reporter_email = deferred(Column(String))
-    owner_uid      = Column(None, ForeignKey('users.uuid'))
-    image_id       = Column(None, ForeignKey('images.id'))
+    owner_uid      = Column(None, ForeignKey('users.uuid'), index=True)
+    image_id       = Column(None, ForeignKey('images.id'), index=True)
 
     owner          = None   # Defined on User.reports
 
@@ -230,9 +538,177 @@ class Abuse(DeclarativeBase):
                        **kwargs)
 
 
+class Blob(DeclarativeBase):
+    """Content addressed storage, shared by every `Image` uploaded with the
+    same content, see ``[storage] dedup``."""
+    __tablename__ = 'blobs'
+
+    # Table Columns
+    key       = Column(String(60), primary_key=True)
+    path      = Column(String, nullable=False)
+    refcount  = Column(Integer, default=0)
+    created   = Column(DateTime)
+
+    # Query Object
+    query = session.query_property(Query)
+
+    def __init__(self, content_hash, extension, uploads_path):
+        #: the content hash plus the extension the versions are saved as,
+        #: which is also the name the original is stored under
+        self.key = content_hash + extension
+        self.path = join(uploads_path, '.blobs', content_hash[:2],
+                         content_hash[2:4])
+        self.refcount = 0
+        self.created = datetime.utcnow()
+
+    def __repr__(self):
+        return "<Blob %s (%d references)>" % (self.key, self.refcount or 0)
+
+    @classmethod
+    def store(cls, content_hash, extension, uploads_path):
+        """Reference the blob holding this content from one more image,
+        creating it when there's none.  Each step commits on its own, off
+        the current session, so that of the uploads of the same content at
+        once the database alone decides which one creates the blob, and
+        no one references a blob whose last image is being deleted.
+
+        Returns the blob's key and whether it was created, in which case
+        writing its files is up to the caller, and so is `release`-ing it
+        should that fail.
+        """
+        blobs = cls.__table__
+        blob = cls(content_hash, extension, uploads_path)
+        engine = application.database_engine
+        while True:
+            result = engine.execute(blobs.update(
+                and_(blobs.c.key==blob.key, blobs.c.refcount>0),
+                values={blobs.c.refcount: blobs.c.refcount + 1}))
+            if result.rowcount == 1:
+                return blob.key, False
+            try:
+                engine.execute(blobs.insert(), key=blob.key, path=blob.path,
+                               refcount=1, created=blob.created)
+            except IntegrityError:
+                # Created meanwhile, or left unreferenced by a `release`
+                # that didn't get to delete it, try again
+                engine.execute(blobs.delete(and_(blobs.c.key==blob.key,
+                                                 blobs.c.refcount<=0)))
+                continue
+            return blob.key, True
+
+    @classmethod
+    def release(cls, connection, key, count=1):
+        """Drop ``count`` references to the blob, deleting it when none is
+        left, in which case `True` is returned and its files should go."""
+        blobs = cls.__table__
+        connection.execute(blobs.update(blobs.c.key==key, values={
+            blobs.c.refcount: blobs.c.refcount - count}))
+        result = connection.execute(blobs.delete(and_(blobs.c.key==key,
+                                                      blobs.c.refcount<=0)))
+        return result.rowcount > 0
+
+
+class DerivativeJob(DeclarativeBase):
+    """Building the resized and thumbnail versions of an uploaded image,
+    when that's deferred to the derivative workers."""
+    __tablename__ = 'derivative_jobs'
+
+    # Table Columns
+    id        = Column(Integer, primary_key=True, autoincrement=True)
+    image_id  = Column(None, ForeignKey('images.id'), index=True)
+    state     = Column(String(10), default='pending', index=True)
+    attempts  = Column(Integer, default=0)
+    error     = Column(String)
+    created   = Column(DateTime)
+    updated   = Column(DateTime)
+    #: when a pending job is due, later for each failed attempt
+    next_attempt = Column(DateTime)
+
+    # Query Object
+    query = session.query_property(Query)
+
+    #: job states
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+    def __init__(self):
+        self.state = self.PENDING
+        self.attempts = 0
+        self.created = self.updated = self.next_attempt = datetime.utcnow()
+
+    def __repr__(self):
+        return "<DerivativeJob %s (%s) Image:%s>" % (self.id, self.state,
+                                                     self.image_id)
+
+    @classmethod
+    def counts(cls):
+        """Return the number of jobs in each state."""
+        counts = dict.fromkeys((cls.PENDING, cls.RUNNING, cls.DONE,
+                                cls.FAILED), 0)
+        counts.update(session.query(cls.state, func.count(cls.id)).group_by(
+            cls.state).all())
+        return counts
+
+
+# The due pending jobs, see `screener.jobs.work`
+Index('ix_derivative_jobs_state_next_attempt',
+      DerivativeJob.__table__.c.state, DerivativeJob.__table__.c.next_attempt)
+
+
+class SpooledMail(DeclarativeBase):
+    """An outgoing email, kept until the mail sender delivers it, see
+    `screener.utils.notification.MailSender`.  Delivered mail is deleted."""
+    __tablename__ = 'mail_spool'
+
+    # Table Columns
+    id            = Column(Integer, primary_key=True, autoincrement=True)
+    sender        = Column(String)
+    recipients    = Column(String)   # comma separated
+    message       = Column(String)
+    state         = Column(String(10), default='pending')
+    attempts      = Column(Integer, default=0)
+    error         = Column(String)
+    created       = Column(DateTime)
+    updated       = Column(DateTime)
+    next_attempt  = Column(DateTime)
+
+    # Query Object
+    query = session.query_property(Query)
+
+    #: mail states
+    PENDING, SENDING, FAILED = 'pending', 'sending', 'failed'
+
+    def __repr__(self):
+        return "<SpooledMail %s (%s) To:%s>" % (self.id, self.state,
+                                                self.recipients)
+
+    @classmethod
+    def enqueue(cls, engine, sender, recipients, message):
+        """Queue ``message`` for delivery, committed right away whatever
+        becomes of the current request."""
+        now = datetime.utcnow()
+        engine.execute(cls.__table__.insert(), sender=sender,
+                       recipients=','.join(recipients), message=message,
+                       state=cls.PENDING, attempts=0, created=now,
+                       updated=now, next_attempt=now)
+
+    @classmethod
+    def counts(cls):
+        """Return the number of queued mails in each state."""
+        counts = dict.fromkeys((cls.PENDING, cls.SENDING, cls.FAILED), 0)
+        counts.update(session.query(cls.state, func.count(cls.id)).group_by(
+            cls.state).all())
+        return counts
+
+Index('ix_mail_spool_state_next_attempt', SpooledMail.__table__.c.state,
+      SpooledMail.__table__.c.next_attempt)
+
+
 class Image(DeclarativeBase):
     __tablename__ = 'images'
-    __mapper_args__ = {'extension': DeleteMapperExtension()}
+    __mapper_args__ = {'extension': [DeleteMapperExtension(),
+                                     DiskUsageMapperExtension(),
+                                     ImageCountMapperExtension(),
+                                     CategoryVersionMapperExtension()]}
 
     # Table Columns
     id             = Column(String(40), primary_key=True)
@@ -246,11 +722,18 @@ class Image(DeclarativeBase):
     adult_content  = Column(Boolean, default=False)
     views          = Column(Integer, default=0)
     category_name  = Column(None, ForeignKey('categories.name'))
-    owner_uid      = Column(None, ForeignKey('users.uuid'))
+    owner_uid      = Column(None, ForeignKey('users.uuid'), index=True)
+    blob_key       = Column(None, ForeignKey('blobs.key'), index=True)
+    image_size     = Column(Integer, default=0)
+    resized_size   = Column(Integer, default=0)
+    thumb_size     = Column(Integer, default=0)
 
     # ForeignKey Association
     abuse         = relation(Abuse, backref='image', uselist=False,
                              cascade="all, delete, delete-orphan")
+    job           = relation(DerivativeJob, backref='image', uselist=False,
+                             cascade="all, delete, delete-orphan")
+    blob          = relation(Blob)
     owner         = None   # Defined on User.images
     category      = None # Associated elsewhere
 
@@ -318,19 +801,61 @@ class Image(DeclarativeBase):
             return self.id
         return "%s.resized%s" % (self._filename_no_extension, self.extension)
 
+    @property
+    def stored_name(self):
+        """The name the image is stored under, its content addressed
+        `Blob` key if it has one."""
+        return self.blob_key or self.filename
+
     @property
     def image_path(self):
-        return join(self.path, self.filename)
+        return version_paths(self.path, self.stored_name)[0]
 
     @property
     def thumb_path(self):
-        return join(self.path, "%s.thumbnail%s" % (self._filename_no_extension,
-                                                   self.extension))
+        return version_paths(self.path, self.stored_name)[2]
 
     @property
     def resized_path(self):
-        return join(self.path, "%s.resized%s" % (self._filename_no_extension,
-                                                 self.extension))
+        return version_paths(self.path, self.stored_name)[1]
+
+    @classmethod
+    def add_views(cls, engine, views):
+        """Bulk add an ``{image_id: views}`` mapping to the images' view
+        counters in one statement."""
+        images = cls.__table__
+        engine.execute(
+            images.update(images.c.id==bindparam('_id'), values={
+                images.c.views: func.coalesce(images.c.views, 0) +
+                                bindparam('_views')}),
+            [{'_id': image_id, '_views': count}
+             for image_id, count in views.iteritems()]
+        )
+
+    def measure(self):
+        """Record the sizes of the image's files, once they're written."""
+        self.image_size = file_size(self.image_path)
+        self.resized_size = file_size(self.resized_path)
+        self.thumb_size = file_size(self.thumb_path)
+
+    @property
+    def derivatives_state(self):
+        """State of the resized and thumbnail versions, one of the
+        `DerivativeJob` states."""
+        job = self.job
+        if job is None and self.blob_key is not None:
+            # Stored on a blob whose versions some other image's job builds
+            job = DerivativeJob.query.filter(and_(
+                DerivativeJob.image_id==Image.id,
+                Image.blob_key==self.blob_key,
+                DerivativeJob.state!=DerivativeJob.DONE)).first()
+        return job and job.state or DerivativeJob.DONE
+
+    @property
+    def cursor(self):
+        """Where the page following this image starts, its stamp and ID,
+        see `Category.visible_images`."""
+        return '%s_%s' % (self.stamp.strftime(CURSOR_STAMP_FORMAT), self.id)
 
     @property
     def etag(self):
@@ -339,22 +864,176 @@ class Image(DeclarativeBase):
         return etag.hexdigest()
 
 
-    def __delete__(self):
-        for path in [self.image_path, self.thumb_path, self.resized_path]:
-            try:
-                remove(path)
-            except OSError:
-                # File does not exist!?
-                pass
-        try:
-            removedirs(self.path)
-        except OSError:
-            # Directory not empty
-            pass
+    def __delete__(self, connection):
+        if self.blob_key is None:
+            remove_image_files(self.path, self.filename)
+        elif Blob.release(connection, self.blob_key):
+            # That was the last image stored on this blob
+            remove_image_files(self.path, self.blob_key)
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """Forget the cached `ImageRecord` for this image, to be called
+        whenever something `ImageRecord` holds changes.  Other processes
+        forget theirs as the change bumps the category's version."""
+        image_path = self.image_path
+        # Images sharing a blob share their versions, and their state
+        image_cache.invalidate_matching(
+            lambda key, record: record.id == self.id or
+                                record.image_path == image_path)
+
+    @classmethod
+    def visible_to(cls, user):
+        """The criterion selecting the images ``user`` may see, `None` when
+        that's all of them."""
+        if user.is_admin:
+            return None
+        return or_(and_(Image.private==False, Image.abuse==None,
+                        Image.adult_content.in_([False,
+                                                 user.show_adult_content])),
+                   and_(Image.private==True, Image.abuse==None,
+                        Image.owner==user))
+
+    @classmethod
+    def resolve(cls, category, image):
+        """Return the `ImageRecord` for the ``category`` and ``image`` names
+        found on an URL, ``image`` being the image ID, its filename or the
+        filename of its thumbnail or resized version.  `None` if there's no
+        such image.
+
+        A cached record is only reused while its category's version is the
+        one it was made at.
+        """
+        key = (category, image)
+        record = image_cache.get(key)
+        if record is not None:
+            if record.category_version == \
+                            Category.current_version(record.category_name):
+                return record
+            image_cache.invalidate(key)
+        category = Category.resolve(category)
+        if category is None:
+            return None
+        filename, extension = splitext(image)
+        if not extension:
+            loaded = cls.query.get(image)
+        else:
+            loaded = cls.query.filter(and_(
+                Image.category_name==category.name,
+                Image.filename.in_([
+                    filename+extension,
+                    filename[:-len('.thumbnail')]+extension,
+                    filename[:-len('.resized')]+extension]))).first()
+        if loaded is None:
+            return None
+        record = ImageRecord(loaded, category.version)
+        image_cache.set(key, record)
+        return record
+
+
+# Category pages seek through images in this order
+Index('ix_images_category_stamp_id', Image.__table__.c.category_name,
+      Image.__table__.c.stamp, Image.__table__.c.id)
+# Random covers, see `Category.overview`
+Index('ix_images_category_id', Image.__table__.c.category_name,
+      Image.__table__.c.id)
+# Images as named on URLs, see `Image.resolve`.  Unique, of the uploads
+# racing for a name only the first one to commit gets it
+Index('ix_images_category_filename_unique', Image.__table__.c.category_name,
+      Image.__table__.c.filename, unique=True)
+
+
+class ImageRecord(object):
+    """The few, hardly ever changing, details needed to serve an `Image`
+    without going through the database, see `Image.resolve`."""
+
+    def __init__(self, image, category_version):
+        self.id = image.id
+        self.filename = image.filename
+        self.mimetype = image.mimetype
+        self.stamp = image.stamp
+        self.private = image.private
+        self.adult_content = image.adult_content
+        self.category_name = image.category_name
+        self.etag = image.etag
+        self.image_path = image.image_path
+        self.thumb_path = image.thumb_path
+        self.resized_path = image.resized_path
+        self.abuse_reported = image.abuse is not None
+        self.abuse_confirmed = self.abuse_reported and image.abuse.confirmed
+        self.derivatives_pending = \
+                        image.derivatives_state != DerivativeJob.DONE
+        #: the category's version, read before anything else, see `resolve`
+        self.category_version = category_version
+
+
+class CategoryRecord(object):
+    """How a category name or secret found on an URL resolves, see
+    `Category.resolve`."""
+
+    def __init__(self, name, secret, private, version):
+        self.name = name
+        self.secret = secret
+        self.private = private
+        self.version = version
+
+
+class CategoryOverview(object):
+    """What the categories list shows of a category, see
+    `Category.overview`."""
+
+    def __init__(self, name, secret, description, private, image_count,
+                 cover=None):
+        self.name = name
+        self.description = description
+        self.private = private
+        self.image_count = image_count
+        #: how the category is named on URLs
+        self.key = private and secret or name
+        #: how the cover's thumbnail is named on URLs, if there's one
+        self.cover = None
+        if cover is not None:
+            cover_id, filename, cover_private = cover
+            if cover_private:
+                self.cover = cover_id
+            else:
+                name, extension = splitext(filename)
+                self.cover = "%s.thumbnail%s" % (name, extension)
+
+    def __url__(self):
+        return url_for('category', category=self.key)
+
+
+class Counter(DeclarativeBase):
+    """A named counter, bumped on the transaction making the change it
+    counts."""
+    __tablename__ = 'counters'
+
+    name  = Column(String(40), primary_key=True)
+    value = Column(Integer, default=0)
+
+    #: bumped whenever a category, or an image on one, is added, deleted
+    #: or changes, see `Category.overview_version`
+    CATEGORIES = 'categories'
+
+    @classmethod
+    def bump(cls, connection, name):
+        counters = cls.__table__
+        result = connection.execute(counters.update(counters.c.name==name,
+            values={counters.c.value: counters.c.value + 1}))
+        if result.rowcount == 0:
+            # Its first bump
+            connection.execute(counters.insert(), name=name, value=1)
+
+    @classmethod
+    def current(cls, name):
+        return session.query(cls.value).filter(cls.name==name).scalar() or 0
 
 
 class Category(DeclarativeBase):
     __tablename__ = 'categories'
+    __mapper_args__ = {'extension': [DeleteMapperExtension(),
+                                     CategoryVersionMapperExtension()]}
 
     # Table Columns
     name        = Column(String(40), primary_key=True)
@@ -362,7 +1041,14 @@ class Category(DeclarativeBase):
     stamp       = Column(DateTime, default=datetime.utcnow())
     description = Column(String)
     private     = Column(Boolean, default=False)
-    owner_uid   = Column(None, ForeignKey('users.uuid'))
+    owner_uid   = Column(None, ForeignKey('users.uuid'), index=True)
+    #: bumped whenever what's shown of the category changes, see
+    #: `bump_category_version`
+    version     = Column(Integer, default=0)
+    #: how many images it has, see `image_counts`
+    images_all    = Column(Integer, default=0)
+    images_public = Column(Integer, default=0)
+    images_adult  = Column(Integer, default=0)
 
     # ForeignKey Association
     images      = dynamic_loader(Image, backref="category",
@@ -382,60 +1068,180 @@ class Category(DeclarativeBase):
         self.secret = secret.hexdigest()
         self.owner = local.request.user
 
-    def __url__(self):
+    def __delete__(self, connection):
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """Forget how this category resolves and every cached `ImageRecord`
+        on it, to be called whenever it's deleted or its privacy changes.
+        Other processes forget theirs as the change bumps its version."""
+        category_cache.invalidate_matching(
+            lambda key, record: record.name == self.name)
+        image_cache.invalidate_matching(
+            lambda key, record: record.category_name == self.name)
+
+    @classmethod
+    def count(cls, connection, name, counts):
+        """Add ``counts``, a dictionary as returned by `image_counts` whose
+        amounts might be negative, to the category's image counters."""
+        categories = cls.__table__
+        values = {}
+        for counter, amount in counts.iteritems():
+            if amount:
+                column = categories.c['images_%s' % counter]
+                values[column] = func.coalesce(column, 0) + amount
+        if values and name is not None:
+            connection.execute(categories.update(categories.c.name==name,
+                                                 values=values))
+
+    @classmethod
+    def current_version(cls, name):
+        """The version of the category ``name``, `None` if it's gone.
+
+        Looked up at most once every ``[cache] versions_ttl`` seconds, so
+        changes made by other processes show up to that much late.  Those
+        made by this one clear the looked up versions right away.
+        """
+        version = category_versions.get(name, -1)
+        if version == -1:
+            version = session.query(func.coalesce(Category.version, 0)) \
+                             .filter(Category.name==name).scalar()
+            category_versions.set(name, version)
+        return version
+
+    @classmethod
+    def resolve(cls, category):
+        """Return the `CategoryRecord` for the category named, or whose
+        secret is, ``category``, `None` if there's no such category.
+
+        Each process caches its own records, which some other process may
+        have changed the category under.  A cached record is only reused
+        while the category's version is the one it was made at.
+        """
+        record = category_cache.get(category)
+        if record is not None:
+            if record.version == cls.current_version(record.name):
+                return record
+            category_cache.invalidate(category)
+        row = session.query(Category.name, Category.secret, Category.private,
+                            func.coalesce(Category.version, 0)).filter(
+            or_(Category.name==category, Category.secret==category)).first()
+        if row is None:
+            return None
+        record = CategoryRecord(*row)
+        category_cache.set(category, record)
+        return record
+
+    @classmethod
+    def lookup(cls, category):
+        """Return the category named, or whose secret is, ``category``, if
+        there's one."""
+        record = category and cls.resolve(category)
+        if record is not None:
+            return cls.query.get(record.name)
+
+    def __url__(self, endpoint='category', **kwargs):
         if self.private:
-            return url_for('category', category=self.secret)
-        return url_for('category', category=self.name)
+            return url_for(endpoint, category=self.secret, **kwargs)
+        return url_for(endpoint, category=self.name, **kwargs)
 
     @classmethod
-    def visible(self):
+    def visible_criterion(cls):
         if local.request.user.is_admin:
             # User is an Admin, return all categories, his and not his
-            return Category.query.all()
+            return None
+        return or_(Category.private==False,
+                   and_(Category.private==True,
+                        Category.owner==local.request.user))
 
-        return Category.query.filter(
-            or_(Category.private==False,
-                and_(Category.private==True,
-                     Category.owner==local.request.user
-                )
-            )
-        ).all()
+    @classmethod
+    def visible(cls):
+        query = Category.query
+        visible = cls.visible_criterion()
+        if visible is not None:
+            query = query.filter(visible)
+        return query.all()
 
-    @property
-    def random(self):
-        user = local.request.user
-        if user.is_admin:
-            available_ids = session.query(Image.id).filter(
-                Image.category==self
-            ).all()
-        else:
-            user = local.request.user
-            available_ids = session.query(Image.id).filter(
-                or_(and_(Image.category==self,
-                         Image.private==False, Image.abuse==None,
-                         Image.adult_content.in_([False,
-                                                  user.show_adult_content])),
-                    and_(Image.private==True, Image.abuse==None,
-                         Image.category==self, Image.owner==user
-                    )
-                )
-            ).all()
-        if available_ids:
-            return Image.query.get(choice([id[0] for id in available_ids]))
-        return []
-
-    def visible_images(self):
-        user = local.request.user
-        if user.is_admin:
-            # User is an Admin, return all images
-            return self.images
-        return Image.query.filter(
-            or_(and_(Image.category==self,
-                     Image.private==False, Image.abuse==None,
-                     Image.adult_content.in_([False, user.show_adult_content])),
-                and_(Image.private==True, Image.abuse==None,
-                     Image.category==self, Image.owner==user
-                )
-            )
-        ).all()
+    @classmethod
+    def overview_version(cls):
+        """Changes whenever a category, or an image on one, is added,
+        deleted or changes."""
+        return Counter.current(Counter.CATEGORIES)
 
+    @classmethod
+    def overview(cls):
+        """Return a `CategoryOverview` of each category the current user
+        may see, at a cost growing with the number of categories, not of
+        images.  Counts come from the image counters, see `count`, plus the
+        user's own private images, and each cover is a single seek on the
+        category's images by ID.  Image IDs being hex digests, the first one
+        from a random ID on is picked, wrapping around to the first image."""
+        user = local.request.user
+        query = session.query(Category.name, Category.secret,
+                              Category.description, Category.private,
+                              Category.images_all, Category.images_public,
+                              Category.images_adult)
+        visible = cls.visible_criterion()
+        if visible is not None:
+            query = query.filter(visible)
+        categories = query.order_by(Category.name).all()
+
+        own = {}
+        if not user.is_admin:
+            own.update(session.query(Image.category_name, func.count(Image.id))
+                       .filter(and_(Image.owner_uid==user.uuid,
+                                    Image.private==True, Image.abuse==None))
+                       .group_by(Image.category_name))
+
+        visible = Image.visible_to(user)
+        probe = '%040x' % getrandbits(160)
+        overview = []
+        for name, secret, description, private, total, public, adult in \
+                                                                categories:
+            if user.is_admin:
+                count = total or 0
+            else:
+                count = (public or 0) + own.get(name, 0)
+                if user.show_adult_content:
+                    count += adult or 0
+            cover = None
+            if count:
+                query = session.query(Image.id, Image.filename, Image.private)\
+                               .filter(Image.category_name==name)
+                if visible is not None:
+                    query = query.filter(visible)
+                query = query.order_by(Image.id)
+                cover = query.filter(Image.id >= probe).first() or \
+                        query.first()
+            overview.append(CategoryOverview(name, secret, description,
+                                             private, count, cover))
+        return overview
+
+    def visible_images_query(self):
+        """Query the images on this category the current user may see."""
+        query = Image.query.filter(Image.category_name==self.name)
+        visible = Image.visible_to(local.request.user)
+        if visible is not None:
+            query = query.filter(visible)
+        return query
+
+    def visible_images(self, after=None, limit=None):
+        """Return the images on this category the current user may see,
+        oldest first.  With ``after``, an image's `Image.cursor`, only those
+        following it, which seeks straight to them whatever page they're
+        on, and whether or not that image is still around.  None with a
+        malformed one."""
+        query = self.visible_images_query()
+        if after is not None:
+            try:
+                stamp, after = after.split('_', 1)
+                stamp = datetime.strptime(stamp, CURSOR_STAMP_FORMAT)
+            except ValueError:
+                return []
+            query = query.filter(or_(Image.stamp > stamp,
+                                     and_(Image.stamp==stamp,
+                                          Image.id > after)))
+        query = query.order_by(Image.stamp, Image.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from PIL import Image as PImage
+from os import (rename, remove, symlink, getpid, open as os_open, close,
+                O_CREAT, O_EXCL, O_WRONLY)
+from os.path import basename, isfile
+from shutil import copyfileobj, move
+from struct import pack, unpack
+from thread import get_ident
+from screener.watermark import apply_watermark
+
+#: the longest side of the resized version of an image
+RESIZED_SIZE = 1100
+#: the longest side of an image thumbnail
+THUMBNAIL_SIZE = 200
+#: how much bigger than a version the image it's resampled from must be
+REDUCING_GAP = 1.5
+#: file extensions which aren't named after their format
+FORMAT_ALIASES = {'jpg': 'jpeg', 'tif': 'tiff'}
+
+def partial_path(path):
+    """Where a file is written before being renamed to ``path``, unique to
+    the writing thread, so that concurrent writers never share it."""
+    return '%s.%d-%d.part' % (path, getpid(), get_ident())
+
+def claim_path(path):
+    """Create ``path``, empty, raising `OSError` if it already exists, so
+    that of the uploads racing for a name only one gets it."""
+    close(os_open(path, O_CREAT | O_EXCL | O_WRONLY, 0644))
+
+def save_image(image, path, extension, **options):
+    """Save ``image`` next to ``path`` and rename it into place, so that no
+    one ever gets served an half written file."""
+    partial = partial_path(path)
+    try:
+        image.save(partial, extension, **options)
+    except:
+        if isfile(partial):
+            remove(partial)
+        raise
+    rename(partial, path)
+
+def same_format(image, extension):
+    """Whether ``image`` is already stored as an ``extension`` file."""
+    extension = extension.lower()
+    return (image.format or '').lower() == FORMAT_ALIASES.get(extension,
+                                                              extension)
+
+#: JPEG markers which stand alone, without a length and a segment
+JPEG_STANDALONE = set([0x01] + range(0xd0, 0xd8))
+#: PNG chunks which only hold metadata: text, EXIF and modification time
+PNG_METADATA = set(['tEXt', 'zTXt', 'iTXt', 'eXIf', 'tIME'])
+
+def strip_jpeg(source, destination):
+    """Copy a JPEG file without its comments and APPn segments, which hold
+    EXIF, XMP, IPTC and ICC metadata, keeping the JFIF (APP0) and Adobe
+    (APP14) ones, which tell how to decode it.  The image data, from the
+    first scan on, is copied as it is."""
+    if source.read(2) != '\xff\xd8':
+        raise IOError("Not a JPEG file")
+    destination.write('\xff\xd8')
+    while True:
+        byte = source.read(1)
+        if byte != '\xff':
+            raise IOError("Broken JPEG file")
+        while byte == '\xff':
+            # Markers may be padded with any number of 0xff bytes
+            byte = source.read(1)
+        if not byte:
+            raise IOError("Truncated JPEG file")
+        marker = ord(byte)
+        if marker in JPEG_STANDALONE:
+            destination.write('\xff' + byte)
+            continue
+        if marker == 0xd9:
+            # End of image before any scan
+            destination.write('\xff' + byte)
+            return
+        header = source.read(2)
+        if len(header) != 2:
+            raise IOError("Truncated JPEG file")
+        length = unpack('>H', header)[0]
+        if length < 2:
+            raise IOError("Broken JPEG file")
+        segment = source.read(length - 2)
+        if 0xe1 <= marker <= 0xef and marker != 0xee or marker == 0xfe:
+            continue
+        destination.write('\xff' + byte + header + segment)
+        if marker == 0xda:
+            copyfileobj(source, destination)
+            return
+
+def strip_png(source, destination):
+    """Copy a PNG file without its `PNG_METADATA` chunks."""
+    signature = source.read(8)
+    if signature != '\x89PNG\r\n\x1a\n':
+        raise IOError("Not a PNG file")
+    destination.write(signature)
+    while True:
+        header = source.read(8)
+        if not header:
+            return
+        if len(header) != 8:
+            raise IOError("Truncated PNG file")
+        length, kind = unpack('>I4s', header)
+        data = source.read(length + 4)
+        if len(data) != length + 4:
+            raise IOError("Truncated PNG file")
+        if kind not in PNG_METADATA:
+            destination.write(header + data)
+        if kind == 'IEND':
+            return
+
+#: how to copy an image of each format without its metadata
+METADATA_STRIPPERS = {'JPEG': strip_jpeg, 'PNG': strip_png}
+
+def keeps_bytes(image, extension, reencode):
+    """Whether `save_original` copies ``image`` instead of encoding it."""
+    return not reencode and image.format in METADATA_STRIPPERS and \
+                                            same_format(image, extension)
+
+def copy_stripped(image, source_path, image_path):
+    """Copy ``image``, read from ``source_path``, to ``image_path`` with
+    `METADATA_STRIPPERS`, ``source_path`` may be ``image_path`` itself."""
+    partial = partial_path(image_path)
+    source = open(source_path, 'rb')
+    try:
+        destination = open(partial, 'wb')
+        try:
+            METADATA_STRIPPERS[image.format](source, destination)
+        finally:
+            destination.close()
+    except:
+        if isfile(partial):
+            remove(partial)
+        raise
+    finally:
+        source.close()
+    rename(partial, image_path)
+
+def place_original(image, source_path, image_path, extension):
+    """Move the upload at ``source_path`` to ``image_path`` for the workers
+    to save the versions of, without its metadata when that takes no
+    decoding, as the original is served meanwhile."""
+    if image.format in METADATA_STRIPPERS and same_format(image, extension):
+        copy_stripped(image, source_path, image_path)
+        remove(source_path)
+    else:
+        move(source_path, image_path)
+
+def save_original(image, source_path, image_path, extension, reencode=True,
+                  watermark_text=None, watermark_font=None):
+    """Save the original image, read from ``source_path``, watermarked if
+    both ``watermark_text`` and ``watermark_font`` are passed.  Returns the
+    image the other versions should be made from.
+
+    Unless ``reencode`` is true or the image needs to be converted or
+    watermarked, a JPEG or PNG image is copied without its metadata instead
+    of being re-encoded, which leaves ``image`` undecoded for
+    `save_derivatives` to decode at a reduced scale.
+    """
+    if not (watermark_font and watermark_text):
+        if keeps_bytes(image, extension, reencode):
+            copy_stripped(image, source_path, image_path)
+        else:
+            save_image(image, image_path, extension, optimize=1)
+        return image
+
+    original = apply_watermark(image, watermark_text, watermark_font)
+    save_image(original, image_path, extension, optimize=1)
+    return original
+
+def fitted_size(size, box):
+    """The size an image of ``size`` is scaled to in order to fit a square
+    ``box``, never scaling up."""
+    width, height = size
+    scale = min(float(box) / width, float(box) / height, 1)
+    return max(int(width * scale), 1), max(int(height * scale), 1)
+
+def decode_for(image, box):
+    """Decode ``image`` at the smallest scale still `REDUCING_GAP` times the
+    size of its version fitting ``box``, which is what the final resample
+    needs to look good.
+
+    JPEG images which weren't decoded yet are decoded straight at 1/2, 1/4
+    or 1/8 of their size (`draft`), any other image which is still too big
+    is shrunk by an integer factor (`reduce`), which is much cheaper than
+    having the final resample go over every source pixel.
+    """
+    target_width, target_height = fitted_size(image.size, box)
+    wanted = (int(target_width * REDUCING_GAP),
+              int(target_height * REDUCING_GAP))
+    if image.format == 'JPEG' and getattr(image, 'im', None) is None:
+        image.draft(image.mode, wanted)
+    image.load()
+    factor = min(image.size[0] // wanted[0], image.size[1] // wanted[1])
+    if factor >= 2 and hasattr(image, 'reduce'):
+        image = image.reduce(factor)
+    return image
+
+def scale_down(image, box):
+    return image.resize(fitted_size(image.size, box), PImage.ANTIALIAS)
+
+def save_derivatives(image, image_path, resized_path, thumbnail_path,
+                     extension):
+    """Save the resized and thumbnail versions of ``image``, as returned by
+    `save_original`.  Both come out of a single decode of the image, the
+    thumbnail being made from the resized version.  Versions which would be
+    as big as the original are symlinks to it, relative ones, all versions
+    being on the same directory."""
+    image_width, image_height = image.size
+    needs_resized = image_width > RESIZED_SIZE
+    needs_thumbnail = image_width > THUMBNAIL_SIZE or \
+                                            image_height > THUMBNAIL_SIZE
+    if needs_resized or needs_thumbnail:
+        decoded = decode_for(image, needs_resized and RESIZED_SIZE
+                                                  or THUMBNAIL_SIZE)
+    # Resized version
+    if needs_resized:
+        decoded = scale_down(decoded, RESIZED_SIZE)
+        save_image(decoded, resized_path, extension, optimize=1, quality=30)
+    else:
+        symlink(basename(image_path), resized_path)
+
+    # Thumbnailed Version
+    if needs_thumbnail:
+        save_image(scale_down(decoded, THUMBNAIL_SIZE), thumbnail_path,
+                   extension, optimize=1)
+    else:
+        symlink(basename(image_path), thumbnail_path)
+
+def benchmark(paths, repeat=3, reencode=True):
+    """Time saving all versions of each image in ``paths`` the way it used
+    to be done, re-encoding the original and then thumbnailing that fully
+    decoded image twice, against `save_original` and `save_derivatives`,
+    with ``reencode`` as ``[derivatives] reencode_originals``.  Yields, per
+    image, its path, size, the best timings and the decoded pixels of both
+    ways."""
+    from inspect import getargspec
+    from os.path import join, splitext
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    from time import time
+
+    # Newer PIL versions first shrink by an integer factor, unless told not
+    # to, which the old code never did
+    thumbnail_options = {}
+    if 'reducing_gap' in getargspec(PImage.Image.thumbnail)[0]:
+        thumbnail_options['reducing_gap'] = None
+
+    def old_path(path, extension, directory):
+        image = PImage.open(path)
+        width, height = image.size
+        save_image(image, join(directory, 'image'), extension, optimize=1)
+        if width > RESIZED_SIZE:
+            image.thumbnail((RESIZED_SIZE, RESIZED_SIZE), PImage.ANTIALIAS,
+                            **thumbnail_options)
+            save_image(image, join(directory, 'resized'), extension,
+                       optimize=1, quality=30)
+        if width > THUMBNAIL_SIZE or height > THUMBNAIL_SIZE:
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+                            PImage.ANTIALIAS, **thumbnail_options)
+            save_image(image, join(directory, 'thumbnail'), extension,
+                       optimize=1)
+        return width * height
+
+    def new_path(path, extension, directory):
+        image = PImage.open(path)
+        image_path = join(directory, 'image')
+        image = save_original(image, path, image_path, extension, reencode)
+        save_derivatives(image, image_path, join(directory, 'resized'),
+                         join(directory, 'thumbnail'), extension)
+        if not keeps_bytes(image, extension, reencode):
+            # Fully decoded to save the original
+            return image.size[0] * image.size[1]
+        box = image.size[0] > RESIZED_SIZE and RESIZED_SIZE or THUMBNAIL_SIZE
+        decoded = decode_for(PImage.open(path), box)
+        return decoded.size[0] * decoded.size[1]
+
+    for path in paths:
+        result = {'path': path, 'size': PImage.open(path).size}
+        extension = splitext(path)[1][1:].lower()
+        extension = FORMAT_ALIASES.get(extension, extension)
+        for name, function in (('old', old_path), ('new', new_path)):
+            timings = []
+            for _ in range(repeat):
+                directory = mkdtemp()
+                try:
+                    started = time()
+                    result[name + '_pixels'] = function(path, extension,
+                                                        directory)
+                    timings.append(time() - started)
+                finally:
+                    rmtree(directory)
+            result[name + '_time'] = min(timings)
+        yield result
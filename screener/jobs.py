@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+import logging
+from datetime import datetime, timedelta
+from os import remove
+from os.path import splitext, islink, isfile
+from time import sleep, time
+from PIL import Image as PImage
+from screener.database import session, DerivativeJob, bump_category_version
+from screener.imaging import save_original, save_derivatives
+from sqlalchemy import select, and_, or_
+
+log = logging.getLogger(__name__)
+
+def claim_job(engine, job_id):
+    """Atomically move a pending job to running, returns `False` if some
+    other worker got to it first."""
+    jobs = DerivativeJob.__table__
+    result = engine.execute(jobs.update(
+        and_(jobs.c.id==job_id, jobs.c.state==DerivativeJob.PENDING),
+        values={jobs.c.state: DerivativeJob.RUNNING,
+                jobs.c.attempts: jobs.c.attempts + 1,
+                jobs.c.updated: datetime.utcnow()}
+    ))
+    return result.rowcount == 1
+
+def requeue_stale_jobs(engine, timeout, max_attempts):
+    """Put back on the queue the jobs whose worker died while running them,
+    failing those which had no attempts left, as it might well be the job
+    that killed it.  Returns how many were put back."""
+    jobs = DerivativeJob.__table__
+    now = datetime.utcnow()
+    stale = and_(jobs.c.state==DerivativeJob.RUNNING,
+                 jobs.c.updated < now - timedelta(seconds=timeout))
+    engine.execute(jobs.update(and_(stale, jobs.c.attempts >= max_attempts),
+        values={jobs.c.state: DerivativeJob.FAILED,
+                jobs.c.error: "The worker running it died", jobs.c.updated: now}
+    ))
+    result = engine.execute(jobs.update(stale,
+        values={jobs.c.state: DerivativeJob.PENDING, jobs.c.next_attempt: now}
+    ))
+    return result.rowcount
+
+def run_job(job_id, max_attempts, reencode=True, retry_delay=30):
+    """Build the resized and thumbnail versions for a claimed job.  A
+    failed job is retried ``retry_delay`` seconds later, twice as long
+    after each attempt, until it made ``max_attempts``."""
+    job = DerivativeJob.query.get(job_id)
+    image = job.image
+    try:
+        if image is None:
+            raise LookupError("The job's image no longer exists")
+        # Leftovers of a previous attempt
+        for path in (image.resized_path, image.thumb_path):
+            if islink(path) or isfile(path):
+                remove(path)
+        extension = splitext(image.filename)[1][1:]
+        source = PImage.open(image.image_path)
+        original = save_original(source, image.image_path, image.image_path,
+                                 extension, reencode)
+        save_derivatives(original, image.image_path, image.resized_path,
+                         image.thumb_path, extension)
+    except Exception, error:
+        log.exception("Derivative job %s failed", job_id)
+        if job.attempts >= max_attempts:
+            job.state = DerivativeJob.FAILED
+        else:
+            job.state = DerivativeJob.PENDING
+            job.next_attempt = datetime.utcnow() + timedelta(
+                seconds=retry_delay * 2 ** (job.attempts - 1))
+        job.error = str(error)
+        job.updated = datetime.utcnow()
+        session.commit()
+        return False
+
+    job.state = DerivativeJob.DONE
+    job.error = None
+    job.updated = datetime.utcnow()
+    image.measure()
+    # The web processes caching the image as pending learn it's done from
+    # the version of the categories showing it
+    if image.blob_key is not None:
+        bump_category_version(session.connection(), blob_key=image.blob_key)
+    else:
+        bump_category_version(session.connection(), image.category_name)
+    session.commit()
+    image.invalidate_cache()
+    return True
+
+def work(application, once=False):
+    """Process derivative jobs until interrupted, or, with ``once``, until
+    no job is due.  Every half ``[derivatives] job_timeout`` the jobs of
+    workers which died are put back on the queue."""
+    config = application.config.derivatives
+    engine = application.database_engine
+    jobs = DerivativeJob.__table__
+    application.bind_to_context()
+    requeued = 0
+    while True:
+        if time() - requeued >= config.job_timeout / 2:
+            requeue_stale_jobs(engine, config.job_timeout,
+                               config.max_attempts)
+            requeued = time()
+        job_ids = [row[0] for row in engine.execute(select(
+            [jobs.c.id], and_(jobs.c.state==DerivativeJob.PENDING,
+                              or_(jobs.c.next_attempt==None,
+                                  jobs.c.next_attempt <= datetime.utcnow())),
+            order_by=[jobs.c.id], limit=10))]
+        processed = 0
+        for job_id in job_ids:
+            if claim_job(engine, job_id):
+                try:
+                    run_job(job_id, config.max_attempts,
+                            config.reencode_originals, config.retry_delay)
+                finally:
+                    session.remove()
+                processed += 1
+        if not processed:
+            if once:
+                return
+            sleep(config.poll_interval)
+
+def _worker(instance_folder):
+    from screener.application import Screener
+    try:
+        work(Screener(instance_folder))
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(instance_folder, workers):
+    """Start ``workers`` worker processes and wait for them."""
+    from multiprocessing import Process
+    processes = [Process(target=_worker, args=(instance_folder,),
+                         name='derivative-worker-%d' % idx)
+                 for idx in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from datetime import datetime, timedelta
+from hashlib import sha1
+from os import link, makedirs, remove, rename, symlink
+from os.path import exists, isdir, isfile, islink, join, splitext
+from screener.database import (session, User, Change, Leecher, LeechDomain,
+                               Abuse, Image, Category, DerivativeJob, Blob,
+                               Counter, version_paths, shard_directory,
+                               remove_image_files, disk_usage, file_size,
+                               usage_difference, charge_report,
+                               image_counts, bump_category_version,
+                               category_cache,
+                               image_cache, IN_CLAUSE_SIZE)
+from screener.utils import application, page_cache
+from shutil import copyfile
+from sqlalchemy import select, and_, bindparam, func
+
+def chunks(items, size=IN_CLAUSE_SIZE):
+    for idx in xrange(0, len(items), size):
+        yield items[idx:idx+size]
+
+def reap_stale_users(engine, max_age=60, batch_size=500):
+    """Delete unconfirmed users that haven't been seen for ``max_age`` days,
+    together with everything they own, ``batch_size`` users per transaction.
+
+    Returns a dictionary with the number of rows deleted per table.
+    """
+    users = User.__table__
+    categories = Category.__table__
+    images = Image.__table__
+    reports = Abuse.__table__
+    jobs = DerivativeJob.__table__
+    changes = Change.__table__
+    leechers = Leecher.__table__
+    domains = LeechDomain.__table__
+
+    reclaimed = dict(users=0, categories=0, images=0, reports=0, changes=0,
+                     leechers=0, leech_domains=0, derivative_jobs=0,
+                     blobs=0)
+    stale = and_(users.c.confirmed==False,
+                 users.c.last_visit < datetime.utcnow()-timedelta(days=max_age))
+
+    def delete(connection, table, column, values, counter):
+        for chunk in chunks(values):
+            result = connection.execute(table.delete(column.in_(chunk)))
+            reclaimed[counter] += result.rowcount
+
+    def ids(connection, column, where, values):
+        found = []
+        for chunk in chunks(values):
+            found.extend(row[0] for row in connection.execute(
+                select([column], where.in_(chunk))))
+        return found
+
+    while True:
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            uuids = [row[0] for row in connection.execute(
+                select([users.c.uuid], stale, limit=batch_size))]
+            if not uuids:
+                transaction.commit()
+                break
+
+            # Deleting a category deletes every image on it, even those
+            # uploaded by someone else
+            category_names = ids(connection, categories.c.name,
+                                 categories.c.owner_uid, uuids)
+            doomed = {}
+            for column, values in ((images.c.owner_uid, uuids),
+                                   (images.c.category_name, category_names)):
+                for chunk in chunks(values):
+                    for row in connection.execute(select(
+                            [images.c.id, images.c.path, images.c.filename,
+                             images.c.blob_key, images.c.owner_uid,
+                             images.c.image_size, images.c.resized_size,
+                             images.c.thumb_size, images.c.category_name,
+                             images.c.private, images.c.adult_content],
+                            column.in_(chunk))):
+                        doomed[row[0]] = tuple(row[1:])
+            image_ids = doomed.keys()
+            references = {}
+            for path, filename, blob_key in (row[:3] for row in
+                                             doomed.itervalues()):
+                if blob_key is not None:
+                    references[blob_key] = references.get(blob_key, 0) + 1
+            leecher_keys = ids(connection, leechers.c.key,
+                               leechers.c.owner_uid, uuids)
+
+            # Others lose the images they had on the reaped categories, and
+            # get back what the reaped users reported of theirs
+            reaped, reported = set(uuids), set(ids(
+                connection, reports.c.image_id, reports.c.image_id, image_ids))
+            for image_id, row in doomed.iteritems():
+                if row[3] not in reaped:
+                    User.charge(connection, row[3], usage_difference({},
+                        disk_usage(*row[4:7], reported=image_id in reported)))
+            for image_id in set(ids(connection, reports.c.image_id,
+                                    reports.c.owner_uid, uuids)):
+                if image_id not in doomed:
+                    charge_report(connection, image_id, False)
+                    bump_category_version(connection, image_id=image_id)
+            # Categories left lose what was reaped from their counters, and
+            # the pages rendered of them
+            for image_id, row in doomed.iteritems():
+                if row[7] not in category_names:
+                    Category.count(connection, row[7], usage_difference({},
+                        image_counts(*row[8:10],
+                                     reported=image_id in reported)))
+            for category_name in set(row[7] for row in doomed.itervalues()):
+                if category_name not in category_names:
+                    bump_category_version(connection, category_name)
+
+            delete(connection, reports, reports.c.image_id, image_ids,
+                   'reports')
+            delete(connection, reports, reports.c.owner_uid, uuids, 'reports')
+            delete(connection, jobs, jobs.c.image_id, image_ids,
+                   'derivative_jobs')
+            delete(connection, images, images.c.id, image_ids, 'images')
+            # Files of images stored on a blob go with its last reference
+            unused = []
+            for blob_key, count in references.iteritems():
+                if Blob.release(connection, blob_key, count):
+                    unused.append(blob_key)
+                    reclaimed['blobs'] += 1
+            delete(connection, categories, categories.c.name, category_names,
+                   'categories')
+            if category_names:
+                Counter.bump(connection, Counter.CATEGORIES)
+            delete(connection, domains, domains.c.leech_key, leecher_keys,
+                   'leech_domains')
+            delete(connection, leechers, leechers.c.key, leecher_keys,
+                   'leechers')
+            delete(connection, changes, changes.c.owner_uid, uuids, 'changes')
+            delete(connection, users, users.c.uuid, uuids, 'users')
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+        # Only touch the files once the rows are really gone
+        for path, filename, blob_key in (row[:3] for row in
+                                         doomed.itervalues()):
+            if blob_key is None:
+                remove_image_files(path, filename)
+            elif blob_key in unused:
+                remove_image_files(path, blob_key)
+        forget_reaped(set(category_names), set(image_ids),
+                      set(row[7] for row in doomed.itervalues()))
+    return reclaimed
+
+def forget_reaped(category_names, image_ids, touched):
+    """Drop what this process has cached of the reaped ``category_names``
+    and ``image_ids``, and the rendered pages of the ``touched`` categories
+    and of the categories list.  The rows went away with plain SQL, without
+    the `__delete__` hooks doing this, other processes go by the versions.
+    """
+    touched = touched | category_names
+    category_cache.invalidate_matching(
+        lambda key, record: record.name in category_names)
+    image_cache.invalidate_matching(
+        lambda key, record: record.id in image_ids or
+                            record.category_name in category_names)
+    if touched:
+        # Keyed by template and `cached_template` key, see `views.base`
+        page_cache.invalidate_matching(
+            lambda key, page: key[1][0] == 'categories' or
+                              (key[1][0] == 'category' and
+                               key[1][1] in touched))
+
+def recount_images(engine):
+    """Recompute every category's image counters, see `Category.count`.
+    Meant to reconcile the counters, anything uploaded meanwhile might be
+    counted twice or not at all.
+
+    Returns the number of categories whose counters were set.
+    """
+    categories = Category.__table__
+    images = Image.__table__
+    reports = Abuse.__table__
+    counters = {}
+    reported = select([reports.c.image_id], reports.c.image_id!=None)
+    for where, is_reported in ((~images.c.id.in_(reported), False),
+                               (images.c.id.in_(reported), True)):
+        for row in engine.execute(select(
+                [images.c.category_name, images.c.private,
+                 images.c.adult_content, func.count(images.c.id)], where,
+                group_by=[images.c.category_name, images.c.private,
+                          images.c.adult_content])):
+            counts = counters.setdefault(row[0], dict(all=0, public=0,
+                                                      adult=0))
+            for counter, amount in image_counts(
+                    row[1], row[2], is_reported).iteritems():
+                counts[counter] += amount * row[3]
+
+    engine.execute(categories.update(values={categories.c.images_all: 0,
+                                             categories.c.images_public: 0,
+                                             categories.c.images_adult: 0}))
+    counters.pop(None, None)
+    if counters:
+        engine.execute(categories.update(
+            categories.c.name==bindparam('_name'), values={
+                categories.c.images_all: bindparam('_all'),
+                categories.c.images_public: bindparam('_public'),
+                categories.c.images_adult: bindparam('_adult')}), [dict(
+                    _name=name, _all=counts['all'], _public=counts['public'],
+                    _adult=counts['adult'])
+                    for name, counts in counters.iteritems()])
+    return len(counters)
+
+def file_hash(filepath, block_size=256*1024):
+    digest = sha1()
+    fileobj = open(filepath, 'rb')
+    try:
+        for block in iter(lambda: fileobj.read(block_size), ''):
+            digest.update(block)
+    finally:
+        fileobj.close()
+    return digest.hexdigest()
+
+def place_file(source, destination, original_name):
+    """Make ``source`` available as ``destination`` too, without touching
+    ``source``, so that an interrupted run leaves nothing half-moved.
+    Symlinks are recreated to point at ``original_name``."""
+    partial = destination + '.part'
+    if exists(partial) or islink(partial):
+        remove(partial)
+    if islink(source):
+        # Versions as big as the original are symlinks to it
+        symlink(original_name, partial)
+    else:
+        try:
+            link(source, partial)
+        except OSError:
+            # Not on the same filesystem
+            copyfile(source, partial)
+    rename(partial, destination)
+
+def place_versions(path, filename, new_path, new_name):
+    """Make the image stored as ``filename`` on ``path``, and its versions,
+    available as ``new_name`` on ``new_path`` too."""
+    if not isdir(new_path):
+        makedirs(new_path)
+    for source, destination in zip(version_paths(path, filename),
+                                   version_paths(new_path, new_name)):
+        if exists(source) or islink(source):
+            place_file(source, destination, new_name)
+
+def deduplicate(uploads_path):
+    """Move the images uploaded before ``[storage] dedup`` was enabled into
+    content addressed blobs, dropping the files of duplicated images.
+
+    Each image is committed on its own, an interrupted run is resumed by
+    running it again.  Yields ``(image, blob, duplicate)`` for each image
+    moved.
+    """
+    image_ids = [row[0] for row in session.execute(select(
+        [Image.__table__.c.id], Image.__table__.c.blob_key==None))]
+    for image_id in image_ids:
+        image = Image.query.get(image_id)
+        if image is None or image.blob_key is not None:
+            continue
+        old_path, old_name = image.path, image.filename
+        if not isfile(image.image_path):
+            continue
+        # Versions are always saved with the original's extension
+        extension = splitext(image.filename)[1]
+        key, created = Blob.store(file_hash(image.image_path), extension,
+                                  uploads_path)
+        blob = Blob.query.get(key)
+        duplicate = not created
+        if created:
+            try:
+                place_versions(old_path, old_name, blob.path, blob.key)
+            except:
+                if Blob.release(application.database_engine, key):
+                    remove_image_files(blob.path, blob.key)
+                raise
+        image.path = blob.path
+        image.blob = blob
+        session.commit()
+        image.invalidate_cache()
+        # Only drop the old files once the image really is on the blob
+        remove_image_files(old_path, old_name)
+        yield image, blob, duplicate
+
+def reshard(uploads_path, levels, width):
+    """Move the images not stored on a blob to where ``[storage]
+    shard_levels`` and ``shard_width`` now place them.
+
+    Meant to be run while Screener serves, the files are first linked to
+    their new place, the image is committed and only then the old files
+    are removed; processes still holding the old place re-resolve it.
+    Each image is committed on its own, an interrupted run is resumed by
+    running it again.  Yields ``(image, old_path)`` for each image moved.
+    """
+    images = Image.__table__
+    rows = session.execute(select([images.c.id, images.c.path,
+                                   images.c.filename, images.c.category_name],
+                                  images.c.blob_key==None)).fetchall()
+    for image_id, path, filename, category_name in rows:
+        new_path = shard_directory(join(uploads_path, category_name),
+                                   filename, levels, width)
+        if new_path == path:
+            continue
+        image = Image.query.get(image_id)
+        if image is None or image.path != path:
+            continue
+        place_versions(path, filename, new_path, filename)
+        image.path = new_path
+        session.commit()
+        image.invalidate_cache()
+        remove_image_files(path, filename)
+        yield image, path
+
+def recount_disk_usage(engine, measure=True):
+    """Recompute every user's disk usage counters from the sizes recorded
+    on their images, which, with ``measure``, are first recorded again
+    from what's on disk.  Meant to reconcile the counters, anything
+    uploaded meanwhile might be counted twice or not at all.
+
+    Returns the number of users whose counters were set.
+    """
+    users = User.__table__
+    images = Image.__table__
+    reports = Abuse.__table__
+    if measure:
+        sizes = []
+        for image_id, path, filename, blob_key in engine.execute(select(
+                [images.c.id, images.c.path, images.c.filename,
+                 images.c.blob_key])).fetchall():
+            sizes.append(dict(zip(
+                ('_image_size', '_resized_size', '_thumb_size'),
+                [file_size(filepath) for filepath in
+                 version_paths(path, blob_key or filename)]),
+                _id=image_id))
+        if sizes:
+            engine.execute(images.update(images.c.id==bindparam('_id'),
+                values={images.c.image_size: bindparam('_image_size'),
+                        images.c.resized_size: bindparam('_resized_size'),
+                        images.c.thumb_size: bindparam('_thumb_size')}),
+                sizes)
+
+    counters = {}
+    reported = select([reports.c.image_id], reports.c.image_id!=None)
+    for where, is_reported in ((~images.c.id.in_(reported), False),
+                               (images.c.id.in_(reported), True)):
+        for row in engine.execute(select(
+                [images.c.owner_uid, func.sum(images.c.image_size),
+                 func.sum(images.c.resized_size),
+                 func.sum(images.c.thumb_size)],
+                where, group_by=[images.c.owner_uid])):
+            usage = counters.setdefault(row[0], dict(images=0, resized=0,
+                                                     thumbs=0, abuse=0))
+            for counter, amount in disk_usage(
+                    *row[1:], reported=is_reported).iteritems():
+                usage[counter] += amount
+
+    engine.execute(users.update(values={users.c.usage_images: 0,
+                                        users.c.usage_resized: 0,
+                                        users.c.usage_thumbs: 0,
+                                        users.c.usage_abuse: 0}))
+    counters.pop(None, None)
+    if counters:
+        engine.execute(users.update(users.c.uuid==bindparam('_uuid'), values={
+            users.c.usage_images: bindparam('_images'),
+            users.c.usage_resized: bindparam('_resized'),
+            users.c.usage_thumbs: bindparam('_thumbs'),
+            users.c.usage_abuse: bindparam('_abuse')}), [dict(
+                _uuid=uuid, _images=usage['images'],
+                _resized=usage['resized'], _thumbs=usage['thumbs'],
+                _abuse=usage['abuse']) for uuid, usage in counters.iteritems()])
+    return len(counters)
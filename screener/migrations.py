@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from datetime import datetime
+from screener.database import metadata, User, Image, Abuse, Category
+from screener.maintenance import recount_disk_usage, recount_images
+from sqlalchemy import (MetaData, Table, select, and_, or_, bindparam,
+                        func)
+from sqlalchemy.exceptions import DBAPIError
+
+#: indexes since replaced by others, by table, dropped once their
+#: replacement exists
+OBSOLETE_INDEXES = {
+    # Replaced by ix_images_category_filename_unique
+    'images': ['ix_images_category_filename'],
+}
+
+#: counter columns, which `upgrade` fills in when it adds them instead of
+#: leaving them NULL, and what recounts them
+RECOUNTED_COLUMNS = [
+    (recount_disk_usage, 'recounted the disk usage of %d users', [
+        'users.usage_images', 'users.usage_resized', 'users.usage_thumbs',
+        'users.usage_abuse', 'images.image_size', 'images.resized_size',
+        'images.thumb_size']),
+    (recount_images, 'recounted the images of %d categories', [
+        'categories.images_all', 'categories.images_public',
+        'categories.images_adult']),
+]
+
+class DuplicateRows(Exception):
+    """Rows sharing the values of a unique index about to be created,
+    which have to be dealt with before `upgrade` can go on."""
+
+    def __init__(self, index, duplicates):
+        self.index = index
+        self.duplicates = duplicates
+        Exception.__init__(self, "Can't create the unique index %s, "
+            "rows share its (%s), rename or delete all but one of each: "
+            "%s" % (index.name, ', '.join(column.name for column in
+                                          index.columns),
+                          '; '.join('%s (%d rows)' % (
+                              ', '.join(repr(value) for value in row[:-1]),
+                              row[-1]) for row in duplicates)))
+
+def column_spec(column, dialect):
+    """The ``ADD COLUMN`` clause for ``column``."""
+    spec = '%s %s' % (dialect.identifier_preparer.format_column(column),
+                      column.type.dialect_impl(dialect).get_col_spec())
+    if column.foreign_keys:
+        foreign_key = list(column.foreign_keys)[0].column
+        spec += ' REFERENCES %s (%s)' % (foreign_key.table.name,
+                                         foreign_key.name)
+    return spec
+
+def index_names(engine, table):
+    """Names of the indexes on ``table``, `None` if there's no telling on
+    this database."""
+    name = engine.dialect.name
+    if name == 'sqlite':
+        query, column = "SELECT name FROM sqlite_master " \
+                        "WHERE type='index' AND tbl_name='%s'" % table.name, 0
+    elif name == 'postgres':
+        query, column = "SELECT indexname FROM pg_indexes " \
+                        "WHERE tablename='%s'" % table.name, 0
+    elif name == 'mysql':
+        query, column = 'SHOW INDEX FROM %s' % table.name, 2
+    else:
+        return None
+    return set(row[column] for row in engine.execute(query))
+
+def duplicate_rows(engine, index):
+    """The values of ``index``'s columns found on more than one row, each
+    followed by how many rows have them."""
+    columns = list(index.columns)
+    return [tuple(row) for row in engine.execute(select(
+        columns + [func.count()], group_by=columns,
+        having=func.count() > 1))]
+
+def drop_index(engine, table, name):
+    if engine.dialect.name == 'mysql':
+        engine.execute('DROP INDEX %s ON %s' % (name, table.name))
+    else:
+        engine.execute('DROP INDEX %s' % name)
+
+def upgrade(engine):
+    """Bring the database created by an older Screener up to date, creating
+    the tables, adding the (nullable) columns and the indexes it lacks, and
+    dropping the `OBSOLETE_INDEXES`.  The `RECOUNTED_COLUMNS` it adds are
+    filled in last.
+
+    Returns a list with a description of each change made.  Raises
+    `DuplicateRows` when a unique index can't be created, having made the
+    changes before it, so it's safe to run again once they're fixed.
+    """
+    changes = []
+    added = set()
+    existing = MetaData()
+    for table in metadata.sorted_tables:
+        if not engine.has_table(table.name):
+            table.create(bind=engine)
+            changes.append('created table %s' % table.name)
+            continue
+        found = Table(table.name, existing, autoload=True, autoload_with=engine)
+        for column in table.columns:
+            if column.name in found.columns:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                table.name, column_spec(column, engine.dialect)))
+            changes.append('added column %s.%s' % (table.name, column.name))
+            added.add('%s.%s' % (table.name, column.name))
+        indexes = index_names(engine, table)
+        for index in table.indexes:
+            if indexes is not None and index.name in indexes:
+                continue
+            if index.unique:
+                duplicates = duplicate_rows(engine, index)
+                if duplicates:
+                    raise DuplicateRows(index, duplicates)
+            try:
+                index.create(bind=engine)
+            except DBAPIError:
+                if indexes is not None:
+                    raise
+                # No telling which indexes exist, this one probably does
+                continue
+            changes.append('created index %s' % index.name)
+        for name in OBSOLETE_INDEXES.get(table.name, ()):
+            if indexes is not None and name in indexes:
+                drop_index(engine, table, name)
+                changes.append('dropped index %s' % name)
+    for recount, change, columns in RECOUNTED_COLUMNS:
+        if added.intersection(columns):
+            changes.append(change % recount(engine))
+    return changes
+
+def hot_queries():
+    """The queries run most often, by name, with sample parameters."""
+    users = User.__table__
+    images = Image.__table__
+    reports = Abuse.__table__
+    categories = Category.__table__
+    category = bindparam('category', 'category')
+    return [
+        ('category by name or secret', select(
+            [categories], or_(categories.c.name==category,
+                              categories.c.secret==category))),
+        ('image by filename (serve_image)', select(
+            [images], and_(images.c.category_name==category,
+                           images.c.filename==bindparam('filename', 'a.png')))),
+        ('image abuse report', select(
+            [reports], reports.c.image_id==bindparam('image_id', '0' * 40))),
+        ('category page (visible_images)', select(
+            [images], and_(images.c.category_name==category,
+                           or_(images.c.stamp > datetime.utcnow(),
+                               and_(images.c.stamp==datetime.utcnow(),
+                                    images.c.id > '0' * 40))),
+            order_by=[images.c.stamp, images.c.id], limit=60)),
+        ('category cover (Category.overview)', select(
+            [images], and_(images.c.category_name==category,
+                           images.c.id >= bindparam('probe', '8' * 40)),
+            order_by=[images.c.id], limit=1)),
+        ("user's images", select(
+            [images], images.c.owner_uid==bindparam('uuid', '0' * 32))),
+        ('user by email (register, reset)', select(
+            [users], users.c.email==bindparam('email', 'me@example.com'))),
+        ('stale users (reap_stale_users)', select(
+            [users.c.uuid], and_(users.c.confirmed==False,
+                                 users.c.last_visit < datetime.utcnow()),
+            limit=500)),
+    ]
+
+def explain(engine):
+    """Yield the name and query plan of each of the `hot_queries`."""
+    if engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN'
+    else:
+        prefix = 'EXPLAIN'
+    for name, query in hot_queries():
+        compiled = query.compile(bind=engine)
+        params = compiled.construct_params()
+        if engine.dialect.positional:
+            params = [params[key] for key in compiled.positiontup]
+        yield name, [' '.join(str(value) for value in row) for row in
+                     engine.execute('%s %s' % (prefix, compiled), params)]
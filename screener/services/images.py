@@ -67,8 +67,6 @@ def upload(request, image, category=None):
         if not isdir(category_path):
             makedirs(category_path)
 
-        current_cwd = getcwd()
-
         filename, ext = splitext(uploaded_file.filename)
         extension = ext[1:]
         if extension.lower() == 'jpg':
@@ -144,8 +142,7 @@ def upload(request, image, category=None):
                     image.thumbnail((1100, 1100), PImage.ANTIALIAS)
                     image.save(resized_path, extension)
             else:
-                chdir(dirname(image_path))
-                symlink(basename(image_path), basename(resized_path))
+                symlink(basename(image_path), resized_path)
 
             # Thumbnailed Version
             thumbnail_path = join(category_path, filename + '.thumbnail' + ext)
@@ -153,12 +150,7 @@ def upload(request, image, category=None):
                 image.thumbnail((200, 200), PImage.ANTIALIAS)
                 image.save(thumbnail_path, extension)
             else:
-                chdir(dirname(image_path))
-                symlink(basename(image_path), basename(thumbnail_path))
-
-            if getcwd() != current_cwd:
-                # Changed directories for symlink'ing, back to old CWD
-                chdir(current_cwd)
+                symlink(basename(image_path), thumbnail_path)
         except OSError, error:
             return generate_template('upload.html',
                 error="File already exists. Submitted the form twice?",
@@ -168,9 +160,6 @@ def upload(request, image, category=None):
             for path in (image_path, resized_path, thumbnail_path):
                 if isfile(path):
                     remove(path)
-            if getcwd() != current_cwd:
-                # Changed directories for symlink'ing, back to old CWD
-                chdir(current_cwd)
             try:
                 removedirs(category_path)
             except OSError:
@@ -187,11 +176,9 @@ def upload(request, image, category=None):
                       description=request.values.get('description'),
                       private=private, submitter_ip=request.remote_addr)
         image.category = category
+        image.measure()
         session.add(image)
         session.commit()
-        # :\   Double Commit!?
-        image.owner.update_disk_usage()
-        session.commit()
         if private:
             flash("Your hidden image can be found <a href=\"%s\">here</a>" %
                   url_for(image, 'show'))
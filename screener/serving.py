@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+import errno
+import logging
+import os
+import signal
+from random import randint
+from select import select
+from threading import Thread, Condition
+from time import time, sleep
+from werkzeug.serving import BaseWSGIServer
+
+log = logging.getLogger(__name__)
+
+class WorkerServer(BaseWSGIServer):
+    """The server run by each worker process, handling up to ``threads``
+    requests at once.  Connections beyond that wait on the listening socket,
+    where any other worker can pick them up."""
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads=8):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.threads = threads
+        self.alive = True
+        self.handled = self.busy = 0
+        self._idle = Condition()
+
+    def process_request(self, request, client_address):
+        self._idle.acquire()
+        try:
+            self.busy += 1
+            self.handled += 1
+        finally:
+            self._idle.release()
+        thread = Thread(target=self.process_request_thread,
+                        args=(request, client_address))
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+        finally:
+            self.close_request(request)
+            self._idle.acquire()
+            try:
+                self.busy -= 1
+                self._idle.notify()
+            finally:
+                self._idle.release()
+
+    def wait_for_thread(self, timeout=1):
+        """Wait until a thread is free, `False` if none did in time."""
+        self._idle.acquire()
+        try:
+            if self.busy >= self.threads:
+                self._idle.wait(timeout)
+            return self.busy < self.threads
+        finally:
+            self._idle.release()
+
+    def serve(self, max_requests=0, graceful_timeout=30):
+        """Serve until stopped or, with ``max_requests``, until that many
+        requests were handled, then wait for those still running."""
+        while self.alive and not (max_requests and
+                                  self.handled >= max_requests):
+            if not self.wait_for_thread():
+                continue
+            try:
+                readable = select([self.socket], [], [], 1)[0]
+            except Exception, error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                # Some other worker may have taken it already
+                self._handle_request_noblock()
+        deadline = time() + graceful_timeout
+        while self.busy and time() < deadline:
+            self.wait_for_thread(deadline - time())
+
+
+class PreforkServer(object):
+    """Serve ``application`` from ``workers`` forked processes, restarting
+    each one after about ``max_requests`` requests, when not zero.
+
+    The application is created before forking so that whatever it loads is
+    shared by the workers, copy on write.  On ``SIGTERM`` or ``SIGINT`` the
+    workers finish the requests they're handling, flush what the
+    application holds in memory and exit.
+    """
+
+    def __init__(self, application, host, port, workers, threads=8,
+                 max_requests=0, graceful_timeout=30):
+        self.application = application
+        self.server = WorkerServer(host, port, application, threads)
+        # Workers race to accept, the losers mustn't block on it
+        self.server.socket.setblocking(0)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        #: ``{pid: (slot, started)}`` of the running workers
+        self.children = {}
+        self.alive = True
+
+    def run(self):
+        # Threads and database connections don't survive forking
+        self.application.before_fork()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.workers):
+            self.spawn(slot)
+        while self.alive:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            slot, started = self.children.pop(pid, (None, None))
+            if slot is not None and self.alive:
+                log.info("Worker %d exited with status %d, restarting it",
+                         pid, status >> 8)
+                if status and time() - started < 1:
+                    # Don't fork in a tight loop if workers keep crashing
+                    sleep(1)
+                self.spawn(slot)
+        self.shutdown()
+
+    def stop(self, signum=None, frame=None):
+        self.alive = False
+
+    def shutdown(self):
+        """Ask the workers to finish, killing those taking too long."""
+        for pid in self.children:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time() + self.graceful_timeout + 5
+        while self.children and time() < deadline:
+            for pid in self.children.keys():
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        del self.children[pid]
+                except OSError:
+                    del self.children[pid]
+            sleep(0.1)
+        for pid in self.children:
+            log.warning("Killing worker %d", pid)
+            self.kill(pid, signal.SIGKILL)
+        self.server.server_close()
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time())
+            log.info("Worker %d started", pid)
+            return
+        # Worker process
+        status = 0
+        try:
+            try:
+                self.work(slot)
+            except:
+                log.exception("Worker %d failed", os.getpid())
+                status = 1
+        finally:
+            os._exit(status)
+
+    def work(self, slot):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: setattr(self.server, 'alive',
+                                                    False))
+        # One worker takes care of the maintenance tasks
+        self.application.after_fork(maintenance=slot == 0)
+        max_requests = self.max_requests
+        if max_requests:
+            # Keep the workers from restarting all at once
+            max_requests += randint(0, max_requests // 10)
+        try:
+            self.server.serve(max_requests, self.graceful_timeout)
+        finally:
+            self.application.shutdown()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from cStringIO import StringIO
+from threading import Thread, Event, Lock
+from time import time
+from urlparse import urlsplit
+from PIL import Image as PImage
+from screener.database import session, Category
+from werkzeug import Client, BaseResponse
+
+def png(color):
+    """A small PNG image, all of ``color``."""
+    data = StringIO()
+    PImage.new('RGB', (64, 64), color).save(data, 'PNG')
+    data.seek(0)
+    return data
+
+def color_of(data):
+    """The color of the top left pixel of an image."""
+    return PImage.open(StringIO(data)).convert('RGB').getpixel((0, 0))
+
+class StressClient(Thread):
+    """A browser of its own, with its own cookie and host name, uploading
+    images no one else does and checking it gets back what it uploaded."""
+
+    def __init__(self, application, results, index, rounds, prefix, start):
+        Thread.__init__(self, name='stress-client-%d' % index)
+        self.client = Client(application, BaseResponse)
+        self.results = results
+        self.index = index
+        self.rounds = rounds
+        self.host = 'client%d.stress.test' % index
+        self.category = '%s-%d' % (prefix, index)
+        self.shared = '%s-shared' % prefix
+        self.start_event = start
+        #: ``{round: color}`` of the shared images this client uploaded
+        self.won = {}
+
+    def request(self, method, path, **kwargs):
+        response = self.client.open(path, method=method,
+                                    base_url='http://%s/' % self.host,
+                                    environ_base={'REMOTE_ADDR': '127.0.0.1'},
+                                    **kwargs)
+        self.results.count('requests')
+        if response.status_code >= 500:
+            self.results.fail('errors', "%s %s: %s" % (
+                method, path, response.status))
+        return response
+
+    def upload(self, category, filename, color, private=True):
+        response = self.request('POST', '/upload', data={
+            'tos': 'yes', 'category_name': category,
+            'category_private': private and 'yes' or 'no',
+            'uploaded_file': (png(color), filename)})
+        location = response.headers.get('Location')
+        if location and urlsplit(location)[1] != self.host:
+            # Sent to the host some other request came in on
+            self.results.fail('contaminated', "%s got redirected to %s" % (
+                self.host, location))
+        return response.status_code == 303
+
+    def check_image(self, category, filename, color):
+        response = self.request('GET', '/category/%s/image/%s' % (category,
+                                                                  filename))
+        if response.status_code != 200:
+            self.results.fail('errors', "%s/%s: %s" % (category, filename,
+                                                       response.status))
+        elif color_of(response.data) != color:
+            self.results.fail('contaminated', "%s/%s isn't the image %s "
+                              "uploaded" % (category, filename, self.host))
+
+    def check_page(self, uploaded):
+        page = self.request('GET', '/category/%s' % self.category).data
+        for filename in uploaded:
+            thumbnail = filename.replace('.png', '.thumbnail.png')
+            if thumbnail not in page and filename not in page:
+                self.results.fail('contaminated', "%s is missing from %s's "
+                                  "category page" % (filename, self.host))
+        for other in range(self.results.clients):
+            if other != self.index and ('c%dr' % other) in page:
+                self.results.fail('contaminated', "%s's category page shows "
+                                  "images of client %d" % (self.host, other))
+
+    def run(self):
+        self.start_event.wait()
+        uploaded = []
+        for round in range(self.rounds):
+            color = (self.index % 256, round % 256, 200)
+            filename = 'c%dr%d.png' % (self.index, round)
+            if self.upload(self.category, filename, color):
+                self.results.count('uploads')
+                uploaded.append(filename)
+                self.check_image(self.category, filename, color)
+            else:
+                self.results.fail('errors', "%s couldn't upload %s" % (
+                    self.host, filename))
+            # Everyone uploads under the same name, only one may get it
+            color = (self.index % 256, round % 256, 100)
+            if self.upload(self.shared, 'race%d.png' % round, color):
+                self.won[round] = color
+            self.check_page(uploaded)
+
+
+class StressResults(object):
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.counters = dict(requests=0, uploads=0, errors=0, contaminated=0)
+        self.failures = []
+        self._lock = Lock()
+
+    def count(self, counter):
+        self._lock.acquire()
+        try:
+            self.counters[counter] += 1
+        finally:
+            self._lock.release()
+
+    def fail(self, counter, message):
+        self._lock.acquire()
+        try:
+            self.counters[counter] += 1
+            self.failures.append(message)
+        finally:
+            self._lock.release()
+
+
+def stress(application, clients=8, rounds=5, keep=False):
+    """Have ``clients`` threads upload ``rounds`` images each, at the same
+    time, to categories of their own and, under the same names, to a shared
+    one, checking that every client reads back its own images, sees only
+    its own on its category pages, and that of the uploads racing for a
+    name exactly one succeeds, with its image stored under that name.
+
+    Returns the `StressResults`, with the time it took in ``elapsed``.
+    """
+    prefix = 'stress%d' % time()
+    results = StressResults(clients)
+    # Created upfront, the clients only race for the images on it
+    seed = StressClient(application, results, clients, 0, prefix, None)
+    seed.upload(seed.shared, 'seed.png', (0, 0, 0), private=False)
+
+    start = Event()
+    threads = [StressClient(application, results, index, rounds, prefix,
+                            start) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    started = time()
+    start.set()
+    for thread in threads:
+        thread.join()
+    results.elapsed = time() - started
+
+    for round in range(rounds):
+        winners = [thread for thread in threads if round in thread.won]
+        if len(winners) != 1:
+            results.fail('contaminated', "%d uploads got race%d.png" % (
+                len(winners), round))
+            continue
+        winners[0].check_image(winners[0].shared, 'race%d.png' % round,
+                               winners[0].won[round])
+
+    if not keep:
+        application.bind_to_context()
+        for category in Category.query.filter(
+                Category.name.like(prefix + '-%')):
+            session.delete(category)
+        session.commit()
+        session.remove()
+    return results
@@ -33,6 +33,7 @@ url_map = Map([
     ]),
     Submount('/category', [
         Rule('/<category>', endpoint='category'),
+        Rule('/<category>/images', endpoint='category.images'),
         Rule('/<category>/thumb/<image>', endpoint='thumb'),
         Rule('/<category>/resized/<image>', endpoint='resized'),
         Rule('/<category>/image/<image>', endpoint='image'),
@@ -52,6 +53,7 @@ url_map = Map([
         Rule('/', endpoint='admin', redirect_to='/manage/users'),
         Rule('/users', endpoint='admin/users'),
         Rule('/categories', endpoint='admin/categories'),
+        Rule('/stats', endpoint='admin/stats'),
     ]),
     #Rule('/_services', endpoint="services")
 ], default_subdomain='', strict_slashes=True)
@@ -65,6 +67,7 @@ handlers = {
     'resized':          views.base.serve_image,
     'upload':           views.base.upload,
     'category':         views.base.category_list,
+    'category.images':  views.base.category_images,
     'categories':       views.base.categories_list,
     'abuse':            views.base.report_abuse,
     'report':           views.base.report_abuse_confirm,
@@ -82,6 +85,7 @@ handlers = {
     'admin':            views.admin.users,
     'admin/users':      views.admin.users,
     'admin/categories': views.admin.categories,
+    'admin/stats':      views.admin.stats,
 
     # RPC Services
     #'services':         services.service
@@ -6,27 +6,96 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
+import logging
 import screener
-from os import path
-from datetime import datetime, timedelta
+from os import path, walk
+from datetime import datetime
+from itertools import chain
+from threading import RLock
+from time import time
 from genshi import Stream
 from genshi.filters.html import HTMLFormFiller
-from genshi.template import TemplateLoader, MarkupTemplate, NewTextTemplate
+from genshi.template import (TemplateLoader, Template, MarkupTemplate,
+                             NewTextTemplate)
 from werkzeug.wrappers import BaseRequest, BaseResponse, ETagRequestMixin
 from werkzeug.local import Local, LocalManager
 from werkzeug.contrib.securecookie import SecureCookie
 from werkzeug.exceptions import NotFound
+from screener.utils.cache import LRUCache
+from screener.utils.uploads import HashingFile, FORM_OVERHEAD
 
 
 __all__ = ['local', 'local_manager', 'request', 'application',
-           'generate_template', 'url_for', 'shared_url', 'format_datetime',
+           'generate_template', 'cached_template', 'configure_templates',
+           'url_for', 'shared_url', 'format_datetime',
            'Request', 'Response']
 
+log = logging.getLogger(__name__)
+
 # calculate the path to the templates an create the template loader
 TEMPLATE_PATH = path.join(path.dirname(screener.__file__), 'templates')
 template_loader = TemplateLoader(TEMPLATE_PATH, auto_reload=True,
                                  variable_lookup='lenient')
 
+class PreparedOnce(object):
+    """Genshi prepares a template on its first use, which two threads
+    mustn't do at once."""
+
+    _prepare_lock = RLock()
+
+    @property
+    def stream(self):
+        if not self._prepared:
+            # Reentrant, preparing a template may prepare those it includes
+            self._prepare_lock.acquire()
+            try:
+                return Template.stream.fget(self)
+            finally:
+                self._prepare_lock.release()
+        return self._stream
+
+class ScreenerMarkupTemplate(PreparedOnce, MarkupTemplate):
+    pass
+
+class ScreenerTextTemplate(PreparedOnce, NewTextTemplate):
+    pass
+
+def template_class(template_name):
+    """The genshi template class ``template_name`` is loaded with."""
+    if template_name.endswith('.txt'):
+        return ScreenerTextTemplate
+    return ScreenerMarkupTemplate
+
+def template_names():
+    """The name of every page and email template."""
+    for dirpath, dirnames, filenames in walk(TEMPLATE_PATH):
+        for filename in sorted(filenames):
+            if filename.endswith(('.html', '.txt')):
+                name = path.relpath(path.join(dirpath, filename),
+                                    TEMPLATE_PATH)
+                yield name.replace(path.sep, '/')
+
+def configure_templates(production=False):
+    """Replace the template loader.  In production mode template files
+    are never checked for changes, which also lets genshi inline the
+    included layouts, and every template is parsed and prepared right away
+    instead of on its first use.
+
+    Returns the number of templates loaded and the seconds it took.
+    """
+    global template_loader
+    names = production and list(template_names()) or []
+    # Included layouts are cached too, under their own names
+    template_loader = TemplateLoader(TEMPLATE_PATH,
+                                     auto_reload=not production,
+                                     variable_lookup='lenient',
+                                     max_cache_size=max(25, 2 * len(names)))
+    started = time()
+    for name in names:
+        # Prepared on first access, before any worker gets to share it
+        template_loader.load(name, cls=template_class(name)).stream
+    return len(names), time() - started
+
 # context locals.  these two objects are use by the application to
 # bind objects to the current context.  A context is defined as the
 # current thread and the current greenlet if there is greenlet support.
@@ -57,15 +126,32 @@ def generate_template(template_name, **context):
         pretty_size=pretty_size,
         request=request
     )
-    if template_name.endswith('.txt'):
-        cls = NewTextTemplate
-    else:
-        cls = MarkupTemplate
-    stream = template_loader.load(template_name, cls=cls).generate(**context)
+    stream = template_loader.load(
+        template_name, cls=template_class(template_name)).generate(**context)
     if formfill:
         return stream | HTMLFormFiller(data=formfill)
     return stream
 
+#: rendered pages, see `cached_template`, sized by the application from the
+#: ``[cache]`` configuration section
+page_cache = LRUCache('pages')
+
+def cached_template(key, template_name, context):
+    """Render a template into a `Response`, reusing the page rendered for
+    the same ``key``.  The key must tell apart everything the page shows,
+    down to who's viewing it.  ``context`` is called for the template's
+    context only when the page has to be rendered.  Pages showing flashed
+    messages are never cached."""
+    if request.session.get('flashes') or request.session.get('errors'):
+        return Response(generate_template(template_name, **context()))
+    key = (template_name, key)
+    page = page_cache.get(key)
+    if page is None:
+        page = generate_template(template_name, **context()).render(
+            'html', encoding=None, doctype='html')
+        page_cache.set(key, page)
+    return Response(page)
+
 def url_for(endpoint, *args, **kwargs):
     if hasattr(endpoint, '__url__'):
         return endpoint.__url__(*args, **kwargs)
@@ -73,8 +159,17 @@ def url_for(endpoint, *args, **kwargs):
         force_external = kwargs.pop('force_external')
     else:
         force_external = False
-    return application.url_adapter.build(endpoint, kwargs,
-                                         force_external=force_external)
+    return url_adapter().build(endpoint, kwargs,
+                               force_external=force_external)
+
+def url_adapter():
+    """The URL adapter of the current request or, outside of requests, one
+    bound to the configured domain."""
+    try:
+        return request.url_adapter
+    except (RuntimeError, AttributeError):
+        # No request bound to the context, or not dispatched yet
+        return application.url_map.bind(application.config.domain)
 
 def shared_url(filename):
     """Returns a URL to a shared resource."""
@@ -97,6 +192,38 @@ def pretty_size(size, format='%.1f'):
         size /= 1024.
     return (format + ' %s') % (size, units[i - 1])
 
+def render_chunks(stream, chunk_size):
+    """Serialize a genshi stream to HTML bit by bit, yielding it in chunks
+    of about ``chunk_size`` characters."""
+    chunk, length = [], 0
+    for text in stream.serialize('html', doctype='html'):
+        chunk.append(text)
+        length += len(text)
+        if length >= chunk_size:
+            yield u''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield u''.join(chunk)
+
+def stream_chunks(stream, chunk_size):
+    """`render_chunks`, with the first chunk rendered right away, so that a
+    template failing early fails the request before its status is sent.
+    The response being under way by the time a later chunk fails, that
+    error is logged and the page cut short there."""
+    chunks = render_chunks(stream, chunk_size)
+    try:
+        first = [chunks.next()]
+    except StopIteration:
+        first = []
+    def rest():
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception:
+            log.exception("Failed rendering %s after sending part of it",
+                          request.path)
+    return chain(first, rest())
+
 def flash(message, error=False):
     request.session.setdefault(error and 'errors' or 'flashes',
                                []).append(message)
@@ -105,9 +232,41 @@ class Request(BaseRequest, ETagRequestMixin):
     """Simple request subclass that allows to bind the object to the
     current context.
     """
+    def __init__(self, environ, populate_request=True, shallow=False):
+        BaseRequest.__init__(self, environ, populate_request, shallow)
+        self.uploads = []
+        self.flashes = {}
+
     def bind_to_context(self):
         local.request = self
 
+    @property
+    def max_content_length(self):
+        return application.config.max_size + FORM_OVERHEAD
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        """Stream uploaded files next to their final location instead of
+        spooling them first, hashing them on the way."""
+        stream = HashingFile(path.join(application.config.uploads_path,
+                                       '.incoming'))
+        self.uploads.append(stream)
+        return stream
+
+    def discard_uploads(self):
+        """Remove the uploaded files which weren't moved elsewhere."""
+        for stream in self.uploads:
+            stream.discard()
+        self.uploads = []
+
+    def pop_flashes(self, kind='flashes'):
+        """The messages flashed of ``kind``, ``'flashes'`` or ``'errors'``,
+        taken off the session the first time they're asked for.  Pages may
+        still be rendering after the session is saved, see `Response`."""
+        if kind not in self.flashes:
+            self.flashes[kind] = self.session.pop(kind, [])
+        return self.flashes[kind]
+
     def login(self, user, permanent=False):
         self.user = user
         self.session['uuid'] = user.uuid
@@ -115,21 +274,6 @@ class Request(BaseRequest, ETagRequestMixin):
         if permanent:
             self.session['pmt'] = permanent
 
-    def cleanup_old_sessions(self):
-        from screener.database import User, session, and_
-        delete_since_query = User.query.filter(and_(
-            User.confirmed==False,
-            User.last_visit < datetime.utcnow()-timedelta(days=60))
-        )
-        delete_since_query_count = delete_since_query.count()
-        if self.user.is_admin and delete_since_query_count:
-            self.session.setdefault('flashes', []).append(
-                "Cleaned up %d old sessions" % delete_since_query_count
-            )
-        for user in delete_since_query:
-            session.delete(user)
-        session.commit()
-
     def logout(self):
         self.session.clear()
 
@@ -164,22 +308,40 @@ class Request(BaseRequest, ETagRequestMixin):
             else:
                 self.login(user)
 
-        self.user.update_last_visit()
-        session.commit()
-        self.cleanup_old_sessions()
+        last_visits = application.last_visits
+        if last_visits is None or self.user in session.new:
+            self.user.update_last_visit()
+            session.commit()
+        else:
+            # Batched write-behind mode, the buffer flushes it later on
+            last_visits.add(self.user.uuid, datetime.utcnow())
 
 class Response(BaseResponse):
     """
     Encapsulates a WSGI response.  Unlike the default response object werkzeug
     provides, this accepts a genshi stream and will automatically render it
     to html.  This makes it possible to switch to xhtml or html5 easily.
+
+    With ``[templates] streaming`` enabled the stream is only serialized as
+    the response is sent, chunk by chunk, so the page starts reaching the
+    client right away, see `stream_chunks`.
     """
 
     default_mimetype = 'text/html'
 
+    #: whether the response is a rendered template, which shows the
+    #: flashed messages
+    from_template = False
+
     def __init__(self, response=None, status=200, headers=None, mimetype=None,
-                 content_type=None):
+                 content_type=None, direct_passthrough=False):
         if isinstance(response, Stream):
-            response = response.render('html', encoding=None, doctype='html')
+            self.from_template = True
+            templates = application.config.templates
+            if templates.streaming:
+                response = stream_chunks(response, templates.chunk_size)
+            else:
+                response = response.render('html', encoding=None,
+                                           doctype='html')
         BaseResponse.__init__(self, response, status, headers, mimetype,
-                              content_type)
+                              content_type, direct_passthrough)
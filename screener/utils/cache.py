@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from threading import Lock
+from time import time
+
+#: every cache created, by name, for the statistics page
+caches = {}
+
+class _Node(object):
+    __slots__ = ('key', 'value', 'expires', 'prev', 'next')
+
+class LRUCache(object):
+    """A thread safe, size bounded, least recently used cache whose entries
+    also expire ``ttl`` seconds after being stored.  A ``max_size`` of ``0``
+    disables the cache.
+
+    Entries living in other processes can't be invalidated from this one,
+    the ``ttl`` is what bounds how stale those can get.
+    """
+
+    def __init__(self, name, max_size=1000, ttl=300):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._lock = Lock()
+        self.clear()
+        caches[name] = self
+
+    def configure(self, max_size, ttl):
+        self._lock.acquire()
+        try:
+            self.max_size = max_size
+            self.ttl = ttl
+            while len(self._map) > max(max_size, 0):
+                self._unlink(self._root.prev)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups or 0.0
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+            if node.expires < time():
+                self._unlink(node)
+                self.misses += 1
+                return default
+            self._move_to_front(node)
+            self.hits += 1
+            return node.value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is None:
+                node = _Node()
+                node.key = key
+                node.prev = node.next = node
+                self._map[key] = node
+            node.value = value
+            node.expires = time() + self.ttl
+            self._move_to_front(node)
+            while len(self._map) > self.max_size:
+                self._unlink(self._root.prev)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is not None:
+                self._unlink(node)
+        finally:
+            self._lock.release()
+
+    def invalidate_matching(self, predicate):
+        """Drop every entry for which ``predicate(key, value)`` is true."""
+        self._lock.acquire()
+        try:
+            for node in self._map.values():
+                if predicate(node.key, node.value):
+                    self._unlink(node)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map = {}
+            self._root = root = _Node()
+            root.prev = root.next = root
+        finally:
+            self._lock.release()
+
+    def _move_to_front(self, node):
+        # Detach (a no-op for a new node) and insert right after the root
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        root = self._root
+        node.prev, node.next = root, root.next
+        root.next.prev = node
+        root.next = node
+
+    def _unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        del self._map[node.key]
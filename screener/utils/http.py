@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from uuid import uuid4
+
+#: more ranges than this on a single request get the whole file instead
+MAX_RANGES = 16
+
+class RangeNotSatisfiable(Exception):
+    """None of the requested byte ranges overlap the file."""
+
+def parse_range_header(value, size):
+    """Parse a ``Range`` header for a file of ``size`` bytes into a list of
+    ``(start, stop)`` tuples, ``stop`` being exclusive.
+
+    Returns `None` if the header should be ignored, ie, it's missing,
+    malformed or asks for too many ranges, and raises `RangeNotSatisfiable`
+    if none of the ranges can be served.
+    """
+    if not value or '=' not in value:
+        return None
+    unit, specs = value.split('=', 1)
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        if '-' not in spec:
+            return None
+        first, last = [part.strip() for part in spec.split('-', 1)]
+        try:
+            if not first:
+                # Suffix range, the last ``last`` bytes
+                if not last:
+                    return None
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, stop = max(size - length, 0), size
+            else:
+                start, stop = int(first), size
+                if last:
+                    stop = int(last) + 1
+                    if stop <= start:
+                        return None
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(stop, size)))
+    if not ranges:
+        raise RangeNotSatisfiable
+    return ranges
+
+def if_range_matches(value, etag):
+    """Check an ``If-Range`` header against our (strong) ``etag``.  Dates
+    and weak tags never match, which means "send the whole file"."""
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('W/'):
+        return False
+    return value.strip('"') == etag
+
+def content_range(start, stop, size):
+    return 'bytes %d-%d/%d' % (start, stop - 1, size)
+
+def iter_file_range(fileobj, start, stop, block_size):
+    """Yield the ``start:stop`` bytes of ``fileobj``."""
+    fileobj.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = fileobj.read(min(block_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+def stream_file_range(fileobj, start, stop, block_size):
+    """Like `iter_file_range` but closes ``fileobj`` once done."""
+    try:
+        for data in iter_file_range(fileobj, start, stop, block_size):
+            yield data
+    finally:
+        fileobj.close()
+
+class MultipartByteranges(object):
+    """A ``multipart/byteranges`` body with one part per requested range."""
+
+    def __init__(self, fileobj, ranges, size, content_type, block_size):
+        self.fileobj = fileobj
+        self.ranges = ranges
+        self.block_size = block_size
+        self.boundary = uuid4().hex
+        self.content_type = 'multipart/byteranges; boundary=%s' % self.boundary
+        self.part_headers = [
+            '--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' % (
+                self.boundary, content_type, content_range(start, stop, size))
+            for start, stop in ranges
+        ]
+        self.trailer = '--%s--\r\n' % self.boundary
+
+    def __len__(self):
+        return sum(len(header) + stop - start + 2 for header, (start, stop)
+                   in zip(self.part_headers, self.ranges)) + len(self.trailer)
+
+    def __iter__(self):
+        try:
+            for header, (start, stop) in zip(self.part_headers, self.ranges):
+                yield header
+                for data in iter_file_range(self.fileobj, start, stop,
+                                            self.block_size):
+                    yield data
+                yield '\r\n'
+            yield self.trailer
+        finally:
+            self.close()
+
+    def close(self):
+        self.fileobj.close()
@@ -8,16 +8,23 @@
 
 import re
 import smtplib
+import logging
+from datetime import datetime, timedelta
 from email.charset import Charset, BASE64
 from thread import start_new_thread
+from time import time
 
 from screener.utils import generate_template, url_for
+from screener.utils.tasks import PeriodicTask
+from sqlalchemy import select, and_
+
+log = logging.getLogger(__name__)
 
 MAXHEADERLEN = 76
 
 class NotificationSystem(object):
 
-    def __init__(self, config):
+    def __init__(self, config, engine=None):
 
         self.enabled     = config.enabled
         self.smtp_server = config.smtp_server
@@ -32,6 +39,12 @@ class NotificationSystem(object):
         if not self.smtp_from and not self.reply_to:
             self.enabled = False
 
+        # Mail is queued on the database and sent in the background, unless
+        # there's no database to queue it on
+        self.mail_sender = None
+        if self.enabled and config.spool and engine is not None:
+            self.mail_sender = MailSender(self, engine, config)
+
         self._charset = Charset()
         self._charset.input_charset = 'utf-8'
         self._charset.header_encoding = BASE64
@@ -73,22 +86,43 @@ class NotificationSystem(object):
 #            return self.format_header(key, mo.group(1), mo.group(2))
         return self.format_header(key, value)
 
-#    def send(self, template, data, torcpts, ccrcpts, mime_headers={}):
-#    def send(self, subject, content, to, mime_headers={}):
-    def send(self, subject, template, data, tos, mime_headers={}):
-        from email.mime.text import MIMEText
-        from email.utils import formatdate
-
-        self.server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+    def connect(self, timeout=None):
+        """Open a new, logged in, SMTP connection."""
+        if timeout is None:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        else:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port,
+                                  timeout=timeout)
         if self.use_tls:
-            self.server.ehlo()
-            if not self.server.esmtp_features.has_key('starttls'):
+            server.ehlo()
+            if not server.esmtp_features.has_key('starttls'):
                 raise Exception("TLS Enabled and yet the smtp server does not "
                                 "support it.")
-            self.server.starttls()
-            self.server.ehlo()
+            server.starttls()
+            server.ehlo()
         if self.smtp_user:
-            self.server.login(self.smtp_user, self.smtp_pass)
+            server.login(self.smtp_user, self.smtp_pass)
+        return server
+
+    def disconnect(self, server):
+        if self.use_tls:
+            # avoid false failure detection when the server closes
+            # the SMTP connection with TLS enabled
+            import socket
+            try:
+                server.quit()
+            except socket.sslerror:
+                pass
+        else:
+            server.quit()
+
+#    def send(self, template, data, torcpts, ccrcpts, mime_headers={}):
+#    def send(self, subject, content, to, mime_headers={}):
+    def compose(self, subject, template, data, tos, mime_headers={}):
+        """Render an email template into the envelope sender and the text
+        of the message."""
+        from email.mime.text import MIMEText
+        from email.utils import formatdate
 
         stream = generate_template('email/%s' % template, **data)
         body = stream.render('text')
@@ -125,23 +159,161 @@ class NotificationSystem(object):
         # Ensure the message complies with RFC2822: use CRLF line endings
         recrlf = re.compile("\r?\n")
         msgtext = CRLF = '\r\n'.join(recrlf.split(msgtext))
-#        self.server.sendmail(msg['From'], (recipients,), msgtext)
-        self.server.sendmail(msg['From'], (tos,), msgtext)
+        return str(msg['From']), msgtext
 
-        if self.use_tls:
-            # avoid false failure detection when the server closes
-            # the SMTP connection with TLS enabled
-            import socket
-            try:
-                self.server.quit()
-            except socket.sslerror:
-                pass
-        else:
-            self.server.quit()
+    def send(self, subject, template, data, tos, mime_headers={}):
+        """Send an email right away, on a connection of its own."""
+        sender, msgtext = self.compose(subject, template, data, tos,
+                                       mime_headers)
+        server = self.connect()
+        try:
+#            server.sendmail(msg['From'], (recipients,), msgtext)
+            server.sendmail(sender, (tos,), msgtext)
+        finally:
+            self.disconnect(server)
 
     def sendmail(self, subject=None, template=None, data=None, tos=None):
         if not self.enabled:
             return
 
-        self.send(subject, template, data, tos)
+        if self.mail_sender is None:
+            self.send(subject, template, data, tos)
+            return
+        sender, msgtext = self.compose(subject, template, data, tos)
+        self.mail_sender.queue(sender, (tos,), msgtext)
 #        start_new_thread(self.send, (subject, content, to))
+
+
+class MailSender(object):
+    """Delivers the mail queued on the spool, see `SpooledMail`.
+
+    Meant to be the callback of a `PeriodicTask`, each run sends whatever is
+    due, ``batch_size`` messages at a time, over a single SMTP connection
+    which is kept open until it's been idle for ``idle_timeout`` seconds.
+    Failed deliveries are retried after ``retry_delay`` seconds, doubling
+    the delay each time, until ``max_attempts`` is reached or the server
+    rejects the message for good.  Several processes can share the spool.
+    """
+
+    def __init__(self, notification, engine, config):
+        self.notification = notification
+        self.engine = engine
+        self.batch_size = config.batch_size
+        self.max_attempts = config.max_attempts
+        self.retry_delay = config.retry_delay
+        self.idle_timeout = config.idle_timeout
+        self.smtp_timeout = config.smtp_timeout
+        self.task = PeriodicTask('mail-sender', self.run, config.poll_interval)
+        self.server = None
+        self.last_used = 0
+
+    def queue(self, sender, recipients, msgtext):
+        from screener.database import SpooledMail
+        SpooledMail.enqueue(self.engine, sender, recipients, msgtext)
+        self.task.wakeup()
+
+    def claim(self, mail_id):
+        """Atomically move a pending mail to sending, returns `False` if
+        some other process got to it first."""
+        from screener.database import SpooledMail
+        spool = SpooledMail.__table__
+        result = self.engine.execute(spool.update(
+            and_(spool.c.id==mail_id, spool.c.state==SpooledMail.PENDING),
+            values={spool.c.state: SpooledMail.SENDING,
+                    spool.c.attempts: spool.c.attempts + 1,
+                    spool.c.updated: datetime.utcnow()}
+        ))
+        return result.rowcount == 1
+
+    def requeue_stale(self, timeout=600):
+        """Put back on the queue the mail whose sender died sending it."""
+        from screener.database import SpooledMail
+        spool = SpooledMail.__table__
+        self.engine.execute(spool.update(
+            and_(spool.c.state==SpooledMail.SENDING,
+                 spool.c.updated < datetime.utcnow() -
+                                   timedelta(seconds=timeout)),
+            values={spool.c.state: SpooledMail.PENDING}
+        ))
+
+    def run(self):
+        """Send the mail that's due, returns how many were sent."""
+        from screener.database import SpooledMail
+        spool = SpooledMail.__table__
+        self.requeue_stale()
+        sent = 0
+        unreachable = False
+        while not unreachable:
+            batch = self.engine.execute(select(
+                [spool.c.id, spool.c.sender, spool.c.recipients,
+                 spool.c.message, spool.c.attempts],
+                and_(spool.c.state==SpooledMail.PENDING,
+                     spool.c.next_attempt <= datetime.utcnow()),
+                order_by=[spool.c.id], limit=self.batch_size)).fetchall()
+            for mail_id, sender, recipients, message, attempts in batch:
+                if not self.claim(mail_id):
+                    continue
+                try:
+                    self.deliver(sender, recipients.split(','), message)
+                except Exception, error:
+                    log.warning("Delivery of spooled mail %s failed: %s",
+                                mail_id, error)
+                    self.failed(mail_id, attempts + 1, error)
+                    if self.server is None:
+                        # No use trying the rest until the next run
+                        unreachable = True
+                        break
+                else:
+                    self.engine.execute(spool.delete(spool.c.id==mail_id))
+                    sent += 1
+            if len(batch) < self.batch_size:
+                break
+        if self.server is not None and \
+                time() - self.last_used > self.idle_timeout:
+            self.close()
+        return sent
+
+    def deliver(self, sender, recipients, message):
+        """Send a message over the open connection, opening one if there's
+        none or the server has dropped it."""
+        for attempt in (1, 2):
+            if self.server is None:
+                self.server = self.notification.connect(self.smtp_timeout)
+            try:
+                self.server.sendmail(sender, recipients, message)
+            except smtplib.SMTPServerDisconnected:
+                # Most likely dropped while idle, try again once
+                self.server = None
+                if attempt == 2:
+                    raise
+            else:
+                self.last_used = time()
+                return
+
+    def failed(self, mail_id, attempts, error):
+        from screener.database import SpooledMail
+        spool = SpooledMail.__table__
+        rejected = isinstance(error, smtplib.SMTPRecipientsRefused) or (
+            isinstance(error, smtplib.SMTPResponseException) and
+            error.smtp_code >= 500)
+        if not isinstance(error, smtplib.SMTPResponseException):
+            # The connection is in an unknown state
+            self.close()
+        values = {spool.c.error: str(error),
+                  spool.c.updated: datetime.utcnow()}
+        if rejected or attempts >= self.max_attempts:
+            values[spool.c.state] = SpooledMail.FAILED
+        else:
+            values[spool.c.state] = SpooledMail.PENDING
+            values[spool.c.next_attempt] = datetime.utcnow() + timedelta(
+                seconds=self.retry_delay * 2 ** (attempts - 1))
+        self.engine.execute(spool.update(spool.c.id==mail_id, values=values))
+
+    def close(self):
+        """Close the SMTP connection, if there's one open."""
+        server, self.server = self.server, None
+        if server is not None:
+            try:
+                self.notification.disconnect(server)
+            except Exception:
+                server.close()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+import logging
+from threading import Thread, Event
+
+log = logging.getLogger(__name__)
+
+class PeriodicTask(object):
+    """Runs ``callback`` on a daemon thread every ``interval`` seconds.
+
+    The task can be woken up early with :meth:`wakeup`.  If ``run_on_stop``
+    is true, :meth:`stop` runs the callback one last time before returning,
+    so whatever the callback is responsible for is never left behind on
+    shutdown.
+    """
+
+    def __init__(self, name, callback, interval, run_on_stop=False):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.run_on_stop = run_on_stop
+        self._thread = None
+        self._wakeup = self._stopped = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def start(self):
+        if self.running:
+            return
+        # Fresh events every time, so a task can be started again on a
+        # forked child where the parent's thread no longer exists.
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name=self.name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def wakeup(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stop(self, timeout=None):
+        if self.running:
+            self._stopped.set()
+            self._wakeup.set()
+            self._thread.join(timeout)
+        self._thread = None
+        if self.run_on_stop:
+            self.run_once()
+
+    def run_once(self):
+        try:
+            self.callback()
+        except Exception:
+            log.exception("Periodic task %r failed", self.name)
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.isSet():
+                break
+            self.run_once()
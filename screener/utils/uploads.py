@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from hashlib import sha1
+from os import chmod, fdopen, makedirs, remove, umask
+from os.path import isdir, isfile
+from tempfile import mkstemp
+
+#: write buffer of the files uploads are streamed into
+BUFFER_SIZE = 256 * 1024
+
+#: how much bigger than the file itself an upload request may be, for the
+#: multipart envelope and the other form fields
+FORM_OVERHEAD = 64 * 1024
+
+#: the mode files get when created with `open`, which `mkstemp` does not
+#: honour, and that the web server serving the uploads needs to read them
+_umask = umask(022)
+umask(_umask)
+FILE_MODE = 0666 & ~_umask
+
+class HashingFile(object):
+    """The file an uploaded file is streamed into, by the form parser, while
+    its size and SHA1 hash are computed on the way.
+
+    It's created on ``directory``, which should be on the same filesystem
+    as the uploads, so the upload can be renamed into place instead of
+    copied.  Whatever is left of it is removed by `discard`.
+    """
+
+    def __init__(self, directory, buffer_size=BUFFER_SIZE):
+        if not isdir(directory):
+            try:
+                makedirs(directory)
+            except OSError:
+                # Created meanwhile by another request
+                pass
+        fd, self.name = mkstemp(suffix='.upload', dir=directory)
+        # Renamed into place as is, it must not stay private to us
+        chmod(self.name, FILE_MODE)
+        self.file = fdopen(fd, 'w+b', buffer_size)
+        self.hash = sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def discard(self):
+        self.file.close()
+        if isfile(self.name):
+            remove(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from threading import Lock
+from screener.utils.tasks import PeriodicTask
+
+def replace(old, new):
+    """Merge function that keeps the most recent value for a key."""
+    return new
+
+def accumulate(old, new):
+    """Merge function that sums the values for a key, for counters."""
+    return old + new
+
+class WriteBehindBuffer(object):
+    """Coalesces per-key updates in memory and hands them in bulk to
+    ``flush_callback``, either every ``interval`` seconds or as soon as
+    ``max_pending`` distinct keys are waiting, whichever comes first.
+
+    ``merge`` decides what happens when a key is updated twice before a
+    flush, by default the newest value wins.
+    """
+
+    def __init__(self, name, flush_callback, interval=30, max_pending=500,
+                 merge=replace):
+        self.flush_callback = flush_callback
+        self.max_pending = max_pending
+        self.merge = merge
+        self.pending = {}
+        self.flushes = 0
+        self._lock = Lock()
+        self._task = PeriodicTask(name, self.flush, interval, run_on_stop=True)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self.pending:
+                value = self.merge(self.pending[key], value)
+            self.pending[key] = value
+            full = len(self.pending) >= self.max_pending
+        finally:
+            self._lock.release()
+        if full:
+            if self._task.running:
+                # Let the flusher thread do the write, not the request
+                self._task.wakeup()
+            else:
+                self.flush()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            pending, self.pending = self.pending, {}
+        finally:
+            self._lock.release()
+        if not pending:
+            return
+        try:
+            self.flush_callback(pending)
+            self.flushes += 1
+        except Exception:
+            # Put the updates back, without overriding newer values, so
+            # they get another chance on the next flush
+            self._lock.acquire()
+            try:
+                for key, value in pending.iteritems():
+                    if key in self.pending:
+                        value = self.merge(value, self.pending[key])
+                    self.pending[key] = value
+            finally:
+                self._lock.release()
+            raise
+
+    def start(self):
+        self._task.start()
+
+    def stop(self):
+        self._task.stop()
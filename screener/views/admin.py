@@ -9,8 +9,9 @@
 from werkzeug.exceptions import Unauthorized
 from werkzeug.utils import redirect
 
-from screener.database import session, User, Category
-from screener.utils import url_for, generate_template, Response
+from screener.database import session, User, Category, DerivativeJob
+from screener.utils import url_for, generate_template, Response, application
+from screener.utils.cache import caches
 
 def users(request):
     if not request.user.is_admin:
@@ -41,8 +42,24 @@ def categories(request):
             _categories=Category.query.all()
         elif 'update' in request.values:
             print 'UPDATE', request.values.getlist('private')
+            updated = []
             for category in _categories:
-                category.private = category.name in \
-                                            request.values.getlist('private')
+                private = category.name in request.values.getlist('private')
+                if category.private != private:
+                    category.private = private
+                    updated.append(category)
+            session.commit()
+            for category in updated:
+                category.invalidate_cache()
     return generate_template('admin/categories.html',
                              categories=_categories)
+
+
+def stats(request):
+    if not request.user.is_admin:
+        raise Unauthorized
+    return generate_template('admin/stats.html',
+                             caches=sorted(caches.values(),
+                                           key=lambda cache: cache.name),
+                             jobs=sorted(DerivativeJob.counts().items()),
+                             templates=application.template_warmup)
@@ -6,45 +6,115 @@
 # License: BSD - Please view the LICENSE file for additional information.
 # ==============================================================================
 
-from PIL import Image as PImage, ImageDraw, ImageFont
+try:
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+from PIL import Image as PImage
 from datetime import timedelta
-from math import atan, degrees
 from mimetypes import guess_type
-from os import remove, makedirs, removedirs, symlink, getcwd, chdir
-from os.path import join, splitext, isfile, isdir, dirname, basename, getsize
-from screener.database import session, User, Category, Image, Abuse, and_, or_
+from os import remove, makedirs, sep
+from os.path import join, splitext, isfile, isdir, getsize, relpath
+from screener.database import (session, User, Category, Image, Abuse, Blob,
+                               DerivativeJob, image_cache, version_paths,
+                               shard_directory, remove_image_files, and_)
+from screener.imaging import (save_original, save_derivatives, claim_path,
+                              place_original)
 from screener.utils import (url_for, Response, ImageAbuseReported, flash,
                             ImageAbuseConfirmed, generate_template,
-                            AdultContentException)
-from tempfile import mktemp
+                            cached_template,
+                            AdultContentException, application)
+from screener.utils.http import (parse_range_header, if_range_matches,
+                                 content_range, stream_file_range,
+                                 MultipartByteranges, RangeNotSatisfiable)
+from sqlalchemy.exceptions import IntegrityError
 from werkzeug.exceptions import NotFound
 from werkzeug.http import remove_entity_headers
-from werkzeug.utils import redirect
+from werkzeug.utils import redirect, url_quote, wrap_file
+
+
+def viewer_key(request):
+    """What, of who's viewing, changes the listings rendered for them: the
+    layout names confirmed users, admins see everything, adult content
+    viewers see more, and so do owners of private images or categories,
+    their own, confirmed or not."""
+    user = request.user
+    if user.is_admin:
+        kind, identity = 'admin', None
+    elif user.owns_private():
+        kind, identity = 'owner', user.uuid
+    elif user.show_adult_content:
+        kind, identity = 'adult', None
+    else:
+        kind, identity = 'anonymous', None
+    if identity is None and user.confirmed:
+        identity = user.username
+    if kind == 'admin':
+        return kind, identity
+    return kind, identity, bool(user.show_adult_content)
 
 
 def categories_list(request):
     """Return the available list of categories"""
-    return generate_template('category_list.html',
-                             categories=Category.visible())
+    # The random covers stay as they were rendered until the page expires
+    return cached_template(('categories', Category.overview_version(),
+                            viewer_key(request)),
+                           'category_list.html',
+                           lambda: dict(categories=Category.overview()))
+
+
+def category_page(request, category):
+    """Return the category named, or whose secret is, ``category``, the page
+    of its images following the one given as ``after`` on the query string
+    and the `Image.cursor` of the page's last image when there are more to
+    come."""
+    category = Category.lookup(category)
+    if category is None:
+        raise NotFound("Category not found.")
+    page_size = request.config.pagination.page_size
+    # One more than needed tells whether there's a next page
+    images = category.visible_images(after=request.args.get('after'),
+                                     limit=page_size + 1)
+    if len(images) > page_size:
+        return category, images[:page_size], images[page_size - 1].cursor
+    return category, images, None
 
 
 def category_list(request, category=None):
     """Return the available list of images under a specific category"""
-    if not category:
+    record = Category.resolve(category)
+    if record is None:
         raise NotFound("Category not found.")
-    category = Category.query.filter(or_(Category.name==category,
-                                         Category.secret==category)).first()
-    if category is None:
-        raise NotFound("Category not found.")
-    return generate_template('category.html', category=category)
+    key = ('category', record.name, record.version, request.args.get('after'),
+           request.config.pagination.page_size, viewer_key(request))
+    def context():
+        category, images, after = category_page(request, record.name)
+        return dict(category=category, images=images, after=after)
+    return cached_template(key, 'category.html', context)
+
+
+def category_images(request, category=None):
+    """Return a page of images under a specific category as an HTML fragment
+    wrapped in JSON, for pages loading the next one in place"""
+    category, images, after = category_page(request, category)
+    fragment = generate_template('category_images.html', category=category,
+                                 images=images)
+    return Response(json.dumps({
+        'html': fragment.render('html', encoding=None),
+        'next': after and url_for(category, 'category.images', after=after)
+    }), mimetype='application/json')
 
 
 def upload(request, category=None):
     """Upload an image"""
-    if category:
-        category = Category.query.filter(or_(Category.name==category,
-                                             Category.secret==category)).first()
+    category = Category.lookup(category)
     if request.method == 'POST':
+        # Refuse oversized uploads before reading a single byte of them
+        if int(request.environ.get('CONTENT_LENGTH') or 0) > \
+                                            request.max_content_length:
+            return generate_template('upload.html', error="File too big.",
+                                     category=category)
         agree_to_tos = request.values.get('tos') == 'yes'
         if not request.user.confirmed and not agree_to_tos:
             error = 'You must agree to the <a href="%s">Terms of Service</a>.'
@@ -57,31 +127,31 @@ def upload(request, category=None):
             return generate_template('upload.html', error="No file uploaded",
                                      formfill=request.values,
                                      category=category)
+        if uploaded_file.stream.size > request.config.max_size:
+            return generate_template('upload.html', error="File too big.",
+                                     formfill=request.values,
+                                     category=category)
+        if request.user.exceeds_quota(uploaded_file.stream.size):
+            return generate_template('upload.html',
+                                     error="You've run out of disk space.",
+                                     formfill=request.values,
+                                     category=category)
         category_name = request.values.get('category_name', 'uncategorized')
         if len(category_name.split()) > 1:
             return generate_template(
                 'upload.html', error="Category names cannot contain spaces",
                 formfill=request.values, category=category)
+        # New categories are only created along with their first image,
+        # written by an autoflush one would lock SQLite for this session
+        # while `Blob.store` writes on a connection of its own
         category = Category.query.get(category_name)
-        if not category:
-            category_description = request.values.get('category_description')
-            category_private = request.values.get('category_private') == 'yes'
-            category = Category(category_name, category_description,
-                                category_private)
-
-
-        if Image.query.filter(and_(Image.filename==uploaded_file.filename,
-                                   Image.category==category)).first():
+        if category and Image.query.filter(and_(
+                Image.filename==uploaded_file.filename,
+                Image.category==category)).first():
             return generate_template(
                 'upload.html', error="Image already exists for this category",
                 formfill=request.values, category=category)
 
-        category_path = join(request.config.uploads_path, category.name)
-        if not isdir(category_path):
-            makedirs(category_path)
-
-        current_cwd = getcwd()
-
         filename, ext = splitext(uploaded_file.filename)
         extension = ext[1:]
         if extension.lower() == 'jpg':
@@ -89,124 +159,128 @@ def upload(request, category=None):
             ext = '.jpeg'
         mimetype, _ = guess_type(uploaded_file.filename)
 
-        tempfile_path = mktemp()
-        tempfile = open(tempfile_path, 'wb')
-        while 1:
-            if tempfile.tell() > request.config.max_size:
-                tempfile.close()
+        # Already streamed to disk, hashed, by `Request._get_file_stream`
+        uploaded_file.stream.flush()
+        tempfile_path = uploaded_file.stream.name
+
+        watermark_text = request.values.get('watermark_text')
+        watermark_font = request.config.watermark.font
+        watermarked = watermark_font and watermark_text
+        # Watermarks must be on the original before anyone gets to see it,
+        # those uploads are never deferred, nor shared with anyone
+        deferred = request.config.derivatives.deferred and not watermarked
+        blob, new_blob = None, False
+        if request.config.storage.dedup and not watermarked:
+            # Referenced from now on, see `release_blob`
+            key, new_blob = Blob.store(uploaded_file.stream.hexdigest(), ext,
+                                       request.config.uploads_path)
+            blob = Blob.query.get(key)
+            storage_path, stored_name = blob.path, blob.key
+            if not new_blob:
+                # Same content uploaded before, all versions are already
+                # there, or being built for that first upload
+                remove(tempfile_path)
+                deferred = False
+
+        def release_blob():
+            """Drop this upload's reference to the blob, removing its files
+            when no other image is stored on it."""
+            if blob is not None and Blob.release(
+                    application.database_engine, blob.key):
+                remove_image_files(storage_path, stored_name)
+
+        if blob is None:
+            stored_name = filename + ext
+            storage_path = shard_directory(
+                join(request.config.uploads_path, category_name), stored_name,
+                request.config.storage.shard_levels,
+                request.config.storage.shard_width)
+
+        if blob is None or new_blob:
+            try:
+                image = PImage.open(tempfile_path)
+            except IOError:
                 remove(tempfile_path)
-                return generate_template('upload.html', error="File too big.",
+                release_blob()
+                return generate_template('upload.html',
+                                         error="Invalid Image File",
                                          formfill=request.values,
                                          category=category)
-            data = uploaded_file.read(2048)
-            if not data:
-                break
-            tempfile.write(data)
-        tempfile.close()
-
-        try:
-            image = PImage.open(tempfile_path)
-        except IOError:
-            remove(tempfile_path)
-            return generate_template('upload.html', error="Invalid Image File",
-                                     formfill=request.values,
-                                     category=category)
 
-        try:
-            image_width, image_height = image.size
-
-            image_path = join(category_path, filename + ext)
-            # Original Image
-            watermark_text = request.values.get('watermark_text')
-            watermark_font = request.config.watermark.font
-            if watermark_font and watermark_text:
-                original = image.convert("RGBA")
-                original_width, original_height = original.size
-                watermark = PImage.new("RGBA", original.size)
-                draw = ImageDraw.ImageDraw(watermark, "RGBA")
-                size = 0
-                while True:
-                    size += 1
-                    nextfont = ImageFont.truetype(watermark_font, size)
-                    nxttxtwidth, nxttxtheight = nextfont.getsize(watermark_text)
-                    if nxttxtwidth + nxttxtheight / 3 > watermark.size[0]:
-                        break
-                    font = nextfont
-                    textwidth, textheight = nxttxtwidth, nxttxtheight
-                draw.setfont(font)
-                draw.text(((watermark.size[0]-textwidth)/2,
-                           (watermark.size[1]-textheight)/2), watermark_text)
-                watermark = watermark.rotate(
-                    degrees(atan(float(original_height)/original_width)),
-                    PImage.BICUBIC
-                )
-                mask = watermark.convert("L").point(lambda x: min(x, 55))
-                watermark.putalpha(mask)
-                original.paste(watermark, None, watermark)
-                original.save(image_path, extension, optimize=1)
-            else:
-                image.save(image_path, extension, optimize=1)
-
-            # Resized version
-            resized_path = join(category_path, filename + '.resized' + ext)
-            if image_width > 1100:
-                if watermark_font and watermark_text:
-                    original.thumbnail((1100, 1100), PImage.ANTIALIAS)
-                    original.save(resized_path, extension, optimize=1, quality=30)
-                else:
-                    image.thumbnail((1100, 1100), PImage.ANTIALIAS)
-                    image.save(resized_path, extension, optimize=1, quality=30)
-            else:
-                chdir(dirname(image_path))
-                symlink(basename(image_path), basename(resized_path))
-
-            # Thumbnailed Version
-            thumbnail_path = join(category_path, filename + '.thumbnail' + ext)
-            if image_width > 200 or image_height > 200:
-                image.thumbnail((200, 200), PImage.ANTIALIAS)
-                image.save(thumbnail_path, extension, optimize=1)
-            else:
-                chdir(dirname(image_path))
-                symlink(basename(image_path), basename(thumbnail_path))
-
-            if getcwd() != current_cwd:
-                # Changed directories for symlink'ing, back to old CWD
-                chdir(current_cwd)
-        except OSError, error:
-            return generate_template('upload.html',
-                error="File already exists. Submitted the form twice?",
-                formfill=request.values,
-                category=category)
-        except IOError:
-            for path in (image_path, resized_path, thumbnail_path):
-                if isfile(path):
-                    remove(path)
-            if getcwd() != current_cwd:
-                # Changed directories for symlink'ing, back to old CWD
-                chdir(current_cwd)
+            if not isdir(storage_path):
+                try:
+                    makedirs(storage_path)
+                except OSError:
+                    # Created meanwhile by another request
+                    pass
+            image_path, resized_path, thumbnail_path = \
+                                    version_paths(storage_path, stored_name)
+            claimed = False
             try:
-                removedirs(category_path)
-            except OSError:
-                # Directory not empty
-                pass
-            return generate_template('upload.html', error="Failed Save Image",
-                                     formfill=request.values,
-                                     category=category)
-        finally:
-            remove(tempfile_path)
-
+                if blob is None:
+                    # Raises OSError when the name's taken
+                    claim_path(image_path)
+                    claimed = True
+                if deferred:
+                    # The workers re-save it, and build the other versions
+                    place_original(image, tempfile_path, image_path,
+                                   extension)
+                else:
+                    original = save_original(
+                        image, tempfile_path, image_path, extension,
+                        request.config.derivatives.reencode_originals,
+                        watermark_text, watermark_font)
+                    save_derivatives(original, image_path, resized_path,
+                                     thumbnail_path, extension)
+            except OSError, error:
+                if claimed:
+                    remove_image_files(storage_path, stored_name)
+                release_blob()
+                return generate_template('upload.html',
+                    error="File already exists. Submitted the form twice?",
+                    formfill=request.values,
+                    category=category)
+            except IOError:
+                if blob is None:
+                    remove_image_files(storage_path, stored_name)
+                release_blob()
+                return generate_template('upload.html',
+                                         error="Failed Save Image",
+                                         formfill=request.values,
+                                         category=category)
+            finally:
+                if isfile(tempfile_path):
+                    remove(tempfile_path)
+
+        if category is None:
+            category = Category(
+                category_name, request.values.get('category_description'),
+                request.values.get('category_private') == 'yes')
         private = request.values.get('private') == 'yes'
         adult_content = request.values.get('adult_content') == 'yes'
-        image = Image(image_path, mimetype,
+        image = Image(join(storage_path, filename + ext), mimetype,
                       description=request.values.get('description'),
                       private=private, submitter_ip=request.remote_addr,
                       adult_content=adult_content)
         image.category = category
+        if blob is not None:
+            image.blob, image.blob_key = blob, blob.key
+        if deferred:
+            image.job = DerivativeJob()
+        image.measure()
         session.add(image)
-        session.commit()
-        # :\   Double Commit!?
-        image.owner.update_disk_usage()
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another upload got this name, or created this category, since
+            # we checked
+            session.rollback()
+            if blob is None:
+                remove_image_files(storage_path, stored_name)
+            release_blob()
+            return generate_template(
+                'upload.html', error="Image already exists for this category",
+                formfill=request.values, category=category)
         if private:
             flash("Your hidden image can be found <a href=\"%s\">here</a>" %
                   url_for(image, 'show'))
@@ -225,110 +299,156 @@ def upload(request, category=None):
 
 def show_image(request, category=None, image=None):
     """Show the resized version of an image"""
-    category = Category.query.filter(or_(Category.name==category,
-                                         Category.secret==category)).first()
-    filename, extension = splitext(image)
-    if not extension:
-        image = Image.query.get(image)
-    else:
-        image = Image.query.filter(
-            and_(Image.filename.in_([filename+extension,
-                                     filename[:-len('.thumbnail')]+extension,
-                                     filename[:-len('.resized')]+extension]),
-                 Image.category==category)).first()
-
-    if not image:
+    record = Image.resolve(category, image)
+    if not record:
         raise NotFound("Requested image was not found")
 
-    if image.abuse and image.abuse.confirmed:
+    if record.abuse_confirmed:
         raise ImageAbuseConfirmed
-    elif image.abuse:
+    elif record.abuse_reported:
         raise ImageAbuseReported
-    if image.adult_content and not request.user.show_adult_content:
+    if record.adult_content and not request.user.show_adult_content:
         raise AdultContentException
 
-    image.views += 1
-    session.commit()
+    image = Image.query.get(record.id)
+    if application.view_counts is None:
+        image.views += 1
+        session.commit()
+    else:
+        # Written in batches, see `Screener.view_counts`
+        application.view_counts.add(image.id, 1)
 
     return generate_template('image.html', image=image)
 
+def picture_on_disk(loaded, image_type):
+    """Return the path and size of the ``image_type`` version of the
+    `ImageRecord` ``loaded``, and whether that's the original standing in
+    for it, raising `OSError` if it's not on disk."""
+    picture_path = getattr(loaded, "%s_path" % image_type)
+    stand_in = False
+    if loaded.derivatives_pending and not isfile(picture_path):
+        # Not built by the derivative workers yet, the original will do
+        picture_path, stand_in = loaded.image_path, True
+    return picture_path, getsize(picture_path), stand_in
+
+
 def serve_image(request, leecher=None, category=None, image=None):
     """Serve the images"""
 
-    category = Category.query.filter(or_(Category.name==category,
-                                         Category.secret==category)).first()
-
-    filename, extension = splitext(image)
-    if not extension:
-        loaded = Image.query.get(image)
-    else:
-        loaded = Image.query.filter(
-            or_(and_(Image.filename==filename+extension,
-                     Image.category==category),
-                and_(Image.filename==filename[:-len('.thumbnail')]+extension,
-                     Image.category==category),
-                and_(Image.filename==filename[:-len('.resized')]+extension,
-                     Image.category==category))).first()
+    loaded = Image.resolve(category, image)
     if not loaded:
         raise NotFound("Requested image was not found")
 
     if not request.user.is_admin:
-        if loaded.abuse and loaded.abuse.confirmed:
+        if loaded.abuse_confirmed:
             raise ImageAbuseConfirmed
-        elif loaded.abuse:
+        elif loaded.abuse_reported:
             raise ImageAbuseReported
     if not request.user.show_adult_content and loaded.adult_content:
         raise AdultContentException
 
+    try:
+        picture_path, size, stand_in = picture_on_disk(loaded,
+                                                       request.endpoint)
+    except OSError:
+        # Moved since it got cached, by ``manage reshard`` or ``manage
+        # dedup``, look it up again
+        image_cache.invalidate((category, image))
+        loaded = Image.resolve(category, image)
+        if not loaded:
+            raise NotFound("Requested image was not found")
+        picture_path, size, stand_in = picture_on_disk(loaded,
+                                                       request.endpoint)
     content_type = loaded.mimetype
-    picture_path = getattr(loaded, "%s_path" % request.endpoint)
-    picture = open(picture_path, 'rb')
-
-    size = getsize(picture_path)
-    # This image won't change, allow caching it for a year
-    expiry = loaded.stamp + timedelta(days=365)
-
-    headers = [
-        # If the image is private, don't allow cache systems to cache it
-        # only the requesting user can cache it
-        ('Cache-Control', loaded.private and 'private' or 'public'),
-        # The rest of the headers
-        ('Content-Length', str(size)),
-        ('Expires', expiry.strftime("%a %b %d %H:%M:%S %Y")),
-        ('ETag', loaded.etag)
-    ]
-    if request.if_none_match.contains(loaded.etag):
+
+    if stand_in:
+        # Neither browsers nor proxies may keep the original in place of
+        # the version about to be built, nor revalidate it as that version
+        etag = None
+        headers = [
+            ('Cache-Control', 'no-cache'),
+            ('Accept-Ranges', 'bytes')
+        ]
+    else:
+        etag = loaded.etag
+        # This image won't change, allow caching it for a year
+        expiry = loaded.stamp + timedelta(days=365)
+
+        headers = [
+            # If the image is private, don't allow cache systems to cache it
+            # only the requesting user can cache it
+            ('Cache-Control', loaded.private and 'private' or 'public'),
+            # The rest of the headers
+            ('Accept-Ranges', 'bytes'),
+            ('Expires', expiry.strftime("%a %b %d %H:%M:%S %Y")),
+            ('ETag', etag)
+        ]
+    if etag is not None and request.if_none_match.contains(etag):
         remove_entity_headers(headers)
         return Response('', 304, headers=headers)
+    if request.method == 'HEAD':
+        headers.append(('Content-Length', str(size)))
+        return Response('', content_type=content_type, headers=headers)
+
+    offload = request.config.serving.offload
+    if offload:
+        # The reverse proxy streams the file, we only say which one.  It
+        # also takes care of any ``Range`` requested.
+        if offload == 'x-accel-redirect':
+            location = relpath(picture_path, request.config.uploads_path)
+            headers.append(('X-Accel-Redirect', '%s/%s' % (
+                request.config.serving.offload_prefix.rstrip('/'),
+                url_quote(location.replace(sep, '/')))))
+        else:
+            headers.append(('X-Sendfile', picture_path))
+        return Response('', content_type=content_type, headers=headers)
 
-    def stream():
+    block_size = request.config.serving.block_size
+    ranges = None
+    if if_range_matches(request.environ.get('HTTP_IF_RANGE'), etag):
         try:
-            while True:
-                data = picture.read(2048)
-                if not data:
-                    break
-                yield data
-        finally:
-            picture.close()
+            ranges = parse_range_header(request.environ.get('HTTP_RANGE'),
+                                        size)
+        except RangeNotSatisfiable:
+            headers.append(('Content-Range', 'bytes */%d' % size))
+            return Response('', 416, headers=headers)
+
+    if ranges and len(ranges) > 1:
+        body = MultipartByteranges(open(picture_path, 'rb'), ranges, size,
+                                   content_type, block_size)
+        headers.append(('Content-Length', str(len(body))))
+        return Response(body, 206, content_type=body.content_type,
+                        headers=headers, direct_passthrough=True)
+
+    if ranges:
+        start, stop = ranges[0]
+        headers.append(('Content-Range', content_range(start, stop, size)))
+        headers.append(('Content-Length', str(stop - start)))
+        picture = open(picture_path, 'rb')
+        if stop == size:
+            # A resumed download, up to the end of the file, the server's
+            # file wrapper can still take care of it
+            picture.seek(start)
+            body = wrap_file(request.environ, picture, block_size)
+        else:
+            body = stream_file_range(picture, start, stop, block_size)
+        return Response(body, 206, content_type=content_type,
+                        headers=headers, direct_passthrough=True)
 
-    return Response(stream(), content_type=content_type, headers=headers)
+    # Hand the file to the server's `wsgi.file_wrapper` (sendfile) when it
+    # has one, otherwise it's read in `block_size` chunks
+    headers.append(('Content-Length', str(size)))
+    picture = wrap_file(request.environ, open(picture_path, 'rb'), block_size)
+    return Response(picture, content_type=content_type, headers=headers,
+                    direct_passthrough=True)
 
 
 def report_abuse(request, category=None, image=None):
-    category = Category.query.filter(or_(Category.name==category,
-                                         Category.secret==category)).first()
-    filename, extension = splitext(image)
-    if not extension:
-        image = Image.query.get(image)
-    else:
-        image = Image.query.filter(
-            and_(Image.filename.in_([filename+extension,
-                                     filename[:-len('.thumbnail')]+extension,
-                                     filename[:-len('.resized')]+extension]),
-                 Image.category==category)).first()
-
-    if not image:
+    record = Image.resolve(category, image)
+    if not record:
         raise NotFound("Requested image was not found")
+    image = Image.query.get(record.id)
+    category = image.category
 
     if image.abuse:
         flash("An abuse report for this image already exists")
@@ -350,8 +470,8 @@ def report_abuse(request, category=None, image=None):
                                       'abuse.txt', {'report': abuse},
                                       reporter_email)
 
-        image.owner.update_disk_usage()
         session.commit()
+        image.invalidate_cache()
     return generate_template('abuse.html', category=category, image=image)
 
 
@@ -370,6 +490,7 @@ def report_abuse_confirm(request, hash=None):
             return redirect(url_for('index'))
         report.confirmed = True
         session.commit()
+        report.image.invalidate_cache()
         flash("The abuse report is now confirmed")
         return redirect(url_for('index'))
     return generate_template('abuse_confirm.html')
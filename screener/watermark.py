@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4 ts=4 fenc=utf-8 et
+# ==============================================================================
+# Copyright © 2009 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+#
+# License: BSD - Please view the LICENSE file for additional information.
+# ==============================================================================
+
+from PIL import Image as PImage, ImageDraw, ImageFont
+from math import atan, degrees
+from screener.utils.cache import LRUCache
+
+#: ``(font, size)`` -> loaded `FreeTypeFont`, a bisection in `font_size`
+#: goes through about twice as many sizes as the found size has bits
+fonts = LRUCache('watermark fonts', max_size=100, ttl=86400)
+
+#: ``(font, text, width)`` -> the font size the text is drawn with
+font_sizes = LRUCache('watermark font sizes', max_size=1000, ttl=86400)
+
+#: ``(font, text, size)`` -> the text drawn at that size as a ``L`` mask,
+#: only as big as the text, a 1920 pixels wide one takes about 300 Kb,
+#: sized from the ``[watermark]`` section
+tiles = LRUCache('watermark tiles', max_size=100, ttl=86400)
+
+def get_font(font, size):
+    """Load ``font`` at ``size`` points, reusing the recently loaded."""
+    key = (font, size)
+    loaded = fonts.get(key)
+    if loaded is None:
+        loaded = ImageFont.truetype(font, size)
+        fonts.set(key, loaded)
+    return loaded
+
+def fits(font, size, text, width):
+    textwidth, textheight = get_font(font, size).getsize(text)
+    return textwidth + textheight / 3 <= width
+
+def font_size(font, text, width):
+    """The biggest size at which ``text`` still fits ``width``, found by
+    bisection instead of trying every size in turn."""
+    key = (font, text, width)
+    size = font_sizes.get(key)
+    if size is not None:
+        return size
+    low, high = 1, 2
+    while fits(font, high, text, width):
+        low, high = high, high * 2
+    # ``low`` fits (or is the smallest size there is), ``high`` doesn't
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(font, middle, text, width):
+            low = middle
+        else:
+            high = middle
+    font_sizes.set(key, low)
+    return low
+
+def get_tile(font, text, size):
+    """``text`` drawn in white on black at ``size`` points, reusing the
+    recently drawn."""
+    key = (font, text, size)
+    tile = tiles.get(key)
+    if tile is None:
+        loaded = get_font(font, size)
+        tile = PImage.new("L", loaded.getsize(text))
+        ImageDraw.Draw(tile).text((0, 0), text, font=loaded, fill=255)
+        tiles.set(key, tile)
+    return tile
+
+def get_overlay(font, text, width, height):
+    """The semi-transparent ``text`` overlay for an image of ``width`` by
+    ``height``, rotated along its diagonal, and where to paste it to have it
+    centred on the image."""
+    tile = get_tile(font, text, font_size(font, text, width))
+    tile = tile.rotate(degrees(atan(float(height)/width)), PImage.BICUBIC,
+                       expand=True)
+    mask = tile.point(lambda x: min(x, 55))
+    overlay = PImage.merge("RGBA", (tile, tile, tile, mask))
+    return overlay, ((width-tile.size[0])/2, (height-tile.size[1])/2)
+
+def apply_watermark(image, text, font):
+    """Return an RGBA copy of ``image`` with ``text`` stamped over it."""
+    original = image.convert("RGBA")
+    overlay, position = get_overlay(font, text, *original.size)
+    original.paste(overlay, position, overlay)
+    return original